@@ -1,129 +1,656 @@
+import cProfile
+import multiprocessing
+import os
+import pstats
 import random
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 
-piece_score = {"K": 0, "Q": 10, "R": 5, "B": 5, "N": 4, "P": 2}
-
-knight_scores = [
-    [1, 1, 1, 1, 1, 1, 1, 1],
-    [1, 2, 2, 2, 2, 2, 2, 1],
-    [1, 2, 3, 3, 3, 3, 2, 1],
-    [1, 2, 3, 4, 4, 3, 2, 1],
-    [1, 2, 3, 4, 4, 3, 2, 1],
-    [1, 2, 3, 3, 3, 3, 2, 1],
-    [1, 2, 2, 2, 2, 2, 2, 1],
-    [1, 1, 1, 1, 1, 1, 1, 1]
-]
-
-bishop_scores = [
-    [4, 3, 2, 1, 1, 2, 3, 4],
-    [3, 4, 3, 2, 2, 3, 4, 3],
-    [2, 3, 4, 3, 3, 4, 3, 2],
-    [1, 2, 3, 4, 4, 3, 2, 1],
-    [1, 2, 3, 4, 4, 3, 2, 1],
-    [2, 3, 4, 3, 3, 4, 3, 2],
-    [3, 4, 3, 2, 2, 3, 4, 3],
-    [4, 3, 2, 1, 1, 2, 3, 4]
-]
-
-queen_scores = [
-    [1, 1, 1, 3, 1, 1, 1, 1],
-    [1, 2, 3, 3, 3, 1, 1, 1],
-    [1, 4, 3, 3, 3, 4, 2, 1],
-    [1, 2, 3, 3, 3, 2, 2, 1],
-    [1, 2, 3, 3, 3, 2, 2, 1],
-    [1, 4, 3, 3, 3, 4, 2, 1],
-    [1, 2, 3, 3, 3, 1, 1, 1],
-    [1, 1, 1, 3, 1, 1, 1, 1]
-]
-
-rook_scores = [
-    [4, 3, 4, 4, 4, 4, 3, 4],
-    [4, 4, 4, 4, 4, 4, 4, 4],
-    [1, 1, 2, 3, 3, 2, 1, 1],
-    [1, 2, 3, 4, 4, 3, 2, 1],
-    [1, 2, 3, 4, 4, 3, 2, 1],
-    [1, 1, 2, 3, 3, 2, 1, 1],
-    [4, 4, 4, 4, 4, 4, 4, 4],
-    [4, 3, 4, 4, 4, 4, 3, 4]
-]
-
-white_pawn_scores = [
-    [8, 8, 8, 8, 8, 8, 8, 8],
-    [8, 8, 8, 8, 8, 8, 8, 8],
-    [5, 6, 6, 7, 7, 6, 6, 5],
-    [2, 3, 3, 4, 4, 3, 3, 2],
-    [1, 2, 3, 4, 4, 3, 2, 1],
-    [1, 1, 2, 3, 3, 2, 1, 1],
-    [1, 1, 1, 0, 0, 1, 1, 1],
-    [0, 0, 0, 0, 0, 0, 0, 0]
-]
-
-black_pawn_scores = [
-    [0, 0, 0, 0, 0, 0, 0, 0],
-    [1, 1, 1, 0, 0, 1, 1, 1],
-    [1, 1, 2, 3, 3, 2, 1, 1],
-    [1, 2, 3, 4, 4, 3, 2, 1],
-    [2, 3, 3, 4, 4, 3, 3, 2],
-    [5, 6, 6, 7, 7, 6, 6, 5],
-    [8, 8, 8, 8, 8, 8, 8, 8],
-    [8, 8, 8, 8, 8, 8, 8, 8]
-]
-
-piece_position_scores = {
-    "N": knight_scores,
-    "Q": queen_scores,
-    "B": bishop_scores,
-    "R": rook_scores,
-    "bP": black_pawn_scores,
-    "wP": white_pawn_scores
-}
+import ChessTablebase
+from ChessScores import POSITION_WEIGHT, piece_score, square_scores
 
 CHECKMATE = 1000
 STALEMATE = 0
 DEPTH = int(3)
+MAX_DEPTH = 64  # iterative deepening never goes deeper than this
+TIME_LIMIT = 1.0  # seconds per move for iterative deepening
+KILLER_SLOTS = 2  # quiet moves remembered per ply that caused a beta cutoff
+WORKERS = os.cpu_count() or 1  # processes a Searcher with root splitting uses by default
+DELTA_MARGIN = 2 * POSITION_WEIGHT  # positional swing beyond the capture itself assumed by delta pruning
+QUIESCENCE_PLIES = 6  # captures deeper than this into quiescence are not searched
+TT_SIZE = 1 << 20  # number of transposition table slots, power of two
+TABLEBASE_WIN = 900  # score of a tablebase win less the plies to mate, below CHECKMATE and above any evaluation
 
-global next_move
-global num_moves
+# transposition table entry flags
+EXACT = 0
+LOWER_BOUND = 1  # search failed high, score is at least this
+UPPER_BOUND = 2  # search failed low, score is at most this
+
+
+class TranspositionTable:
+    """
+    Fixed size table of searched positions indexed by GameState.zobrist_key.
+    Each slot holds (key, depth, score, flag, best move_id, age); a slot is only replaced
+    by a search of at least the same depth, unless it was written by an older search.
+    """
+
+    def __init__(self, size=TT_SIZE):
+        self.size = size
+        self.mask = size - 1
+        self.entries = [None] * size
+        self.age = 0
+
+    def new_search(self):
+        self.age += 1
+
+    def clear(self):
+        self.entries = [None] * self.size
+        self.age = 0
+
+    def probe(self, key):
+        """
+        :return: entry stored for key or None
+        """
+        entry = self.entries[key & self.mask]
+        if entry is not None and entry[0] == key:
+            return entry
+        return None
+
+    def store(self, key, depth, score, flag, best_move_id):
+        index = key & self.mask
+        entry = self.entries[index]
+        if entry is None or entry[0] == key or depth >= entry[1] or entry[5] != self.age:
+            self.entries[index] = (key, depth, score, flag, best_move_id, self.age)
+
+
+tablebases = ChessTablebase.open_tablebases()  # shared read only by every Searcher, None without tables
+
+# move ordering values, unlike piece_score the king is the most expensive attacker
+ORDER_VALUES = {"P": 1, "N": 3, "B": 3, "R": 5, "Q": 9, "K": 10}
+TT_MOVE_ORDER = 1000000
+CAPTURE_ORDER = 100000
+KILLER_ORDER = 90000
+PROFILED_FUNCTIONS = ("get_valid_moves", "get_capture_moves", "make_move", "undo", "score_board", "order_moves",
+                      "quiescence")  # hot paths whose cumulative time Searcher.stats reports
+
+
+class SearchTimeout(Exception):
+    """raised inside the search when the time or node budget of the move is used up"""
+
+
+class SearchResult:
+    """
+    outcome of Searcher.search: best move (None without legal moves), its score for the side to move,
+    the principal variation starting with the move, the deepest completed depth and Searcher.stats()
+    """
+    __slots__ = ("move", "score", "pv", "depth", "stats")
+
+    def __init__(self, move, score, pv, depth, stats):
+        self.move = move
+        self.score = score
+        self.pv = pv
+        self.depth = depth
+        self.stats = stats
 
 
 def random_move(valid_moves):
     return valid_moves[random.randint(0, len(valid_moves) - 1)]
 
 
-def find_move_nega_max_alpha_beta(gs, valid_moves):
-    global next_move
-    global num_moves
-    num_moves = 0
-    next_move = None
-    nega_max_alpha_beta(gs, valid_moves, DEPTH, -CHECKMATE, CHECKMATE, 1 if gs.white_turn else -1)
-    return next_move
-
-
-def nega_max_alpha_beta(gs, valid_moves, depth, alpha, beta, turn_multiplier):
-    global next_move, num_moves
-    num_moves += 1
-    if depth == 0:
-        return turn_multiplier * score_board(gs)
-
-    max_score = -CHECKMATE
-    for move in valid_moves:
-        piece = gs.board[move.end_col][move.end_col]
-        score = move_order(move)  # move ordering
-        if piece != "--":
-            score += piece_score[piece[1]]
-            if gs.square_under_attack(move.end_row, move.end_col):
-                score -= piece_score[piece[1]]
-        gs.make_move(move)
-        nm = gs.get_valid_moves
-        score += - nega_max_alpha_beta(gs, nm, depth - 1, -beta, -alpha, -turn_multiplier)
-        if score > max_score:
-            max_score = score
-            if depth == DEPTH:
-                next_move = move
-        gs.undo()
-        alpha = max(alpha, max_score)
-        if alpha >= beta:
-            break
-    return max_score
+def tablebase_score(outcome, plies):
+    """
+    :return: score for the side to move of a tablebase result, faster mates score higher
+    """
+    return outcome * (TABLEBASE_WIN - plies)
+
+
+class Searcher:
+    """
+    Alpha-beta search with its own transposition table, move ordering tables, limits and counters.
+    Searchers share nothing but the read only tablebases, so every game or thread can own one;
+    one Searcher runs one search at a time.
+    """
+
+    def __init__(self, tt_size=TT_SIZE, workers=1, tablebases=tablebases):
+        """
+        :param workers: processes a search splits the root moves between, 1 searches in this thread
+        """
+        self.transposition_table = TranspositionTable(tt_size)
+        self.tablebases = tablebases
+        self.workers = workers
+        self.pool = None  # process pool of the root splitting search, created on first use
+        self.pool_stop = None  # multiprocessing.Event the pool processes poll, set by stop
+        self.stop_event = None  # multiprocessing.Event of the parent Searcher when this one runs in a pool process
+        self.split_pv = []  # move_ids of the principal variation the winning pool process reported
+        self.stop_requested = False  # set by stop, also before the search started, cleared when it returns
+        self.iteration_callback = None  # called with (depth, best move, score) after every completed depth
+        self.search_depth = DEPTH  # depth of the root of the running iteration
+        self.deadline = None  # time.time() after which the running search is aborted
+        self.ponder_deadline = None  # deadline set by ponder_hit, kept when the hit comes before the search starts
+        self.node_limit = None  # number of nodes after which the running search is aborted
+        self.next_move = None
+        self.next_score = 0  # score of next_move, a lower bound while the iteration runs
+        self.root_move = None  # move_id of the best root move of the previous iteration, searched first
+        self.killer_moves = []  # move_ids per ply
+        self.history = {}  # move_id -> bonus collected by quiet moves that caused a beta cutoff
+        self.completed_iterations = []  # (depth, best move, score) of every finished depth
+        self.profile = None  # cProfile.Profile of the last search when it was run with profile=True
+        self.seconds = 0.0  # wall time of the last search
+        self.new_search()
+
+    def new_search(self):
+        """
+        resets the per move counters and move ordering tables
+        """
+        self.nodes = self.cutoffs = self.first_move_cutoffs = self.leaf_nodes = self.quiescence_nodes = 0
+        self.tt_probes = self.tt_hits = self.tablebase_hits = 0
+        self.iteration_nodes = []  # nodes searched by every completed depth
+        self.completed_depth = 0
+        self.root_move = None
+        self.killer_moves = [[None] * KILLER_SLOTS for _ in range(MAX_DEPTH)]
+        self.history = {}
+        self.transposition_table.new_search()
+
+    def stop(self):
+        """
+        aborts the running search from another thread, it returns the best move found so far
+        """
+        self.stop_requested = True
+        if self.pool_stop is not None:
+            self.pool_stop.set()  # root splitting processes stop too
+
+    def ponder_hit(self, time_limit):
+        """
+        gives a search that was started without a time limit time_limit seconds from now,
+        also when the search has not reached its first node yet
+        """
+        self.ponder_deadline = self.deadline = time.time() + time_limit
+
+    def search(self, gs, valid_moves=None, time_limit=TIME_LIMIT, nodes=None, depth=MAX_DEPTH, profile=False):
+        """
+        searches depth 1, 2, 3 ... until the time or node budget runs out
+        :param time_limit: seconds for this move, None for no limit
+        :param nodes: node budget for this move (of every worker process), None for no limit
+        :param depth: deepest depth to search
+        :param profile: run the search under cProfile, see stats
+        :return: SearchResult
+        """
+        if valid_moves is None:
+            valid_moves = gs.get_valid_moves
+        self.profile = cProfile.Profile() if profile else None
+        start_time = time.perf_counter()
+        if self.profile is not None:
+            self.profile.enable()
+        try:
+            split = self.workers > 1 and len(valid_moves) > 1
+            if split:
+                move, score = self._search_parallel(gs, valid_moves, time_limit, nodes, depth)
+            else:
+                move, score = self._iterative_deepening(gs, valid_moves, time_limit, nodes, depth)
+        finally:
+            if self.profile is not None:
+                self.profile.disable()
+            self.stop_requested = False  # a stop only ends the search it was meant for
+            self.seconds = time.perf_counter() - start_time
+        if move is None:
+            pv = []
+        elif split:  # this process' table is empty, the pool process that found the move knows the line
+            pv = self.moves_from_ids(gs, self.split_pv) or [move]
+        else:
+            pv = self.principal_variation(gs, move, max(self.completed_depth, 1))
+        return SearchResult(move, score, pv, self.completed_depth, self.stats())
+
+    def _iterative_deepening(self, gs, valid_moves, time_limit, nodes, max_depth):
+        """
+        :return: (best move, score) of the last completed depth
+        """
+        self.new_search()
+        self.deadline = self.ponder_deadline if time_limit is None else time.time() + time_limit
+        self.node_limit = nodes
+        self.completed_iterations = []
+        if self.tablebases is not None:
+            found = self.tablebases.best_move(gs, valid_moves)
+            if found is not None:
+                score = tablebase_score(found[1], found[2])
+                self.completed_iterations.append((1, found[0], score))
+                self.completed_depth = 1
+                return found[0], score
+        best_move, best_score = None, 0
+        history_length = len(gs.move_log)
+        for depth in range(1, max_depth + 1):
+            self.next_move = None
+            self.search_depth = depth
+            # previous principal variation first, deeper nodes reuse it through the table
+            self.root_move = None if best_move is None else best_move.move_id
+            try:
+                score = self.nega_max_alpha_beta(gs, valid_moves, depth, -CHECKMATE, CHECKMATE,
+                                                 1 if gs.white_turn else -1)
+            except SearchTimeout:
+                while len(gs.move_log) > history_length:  # unwind the moves of the aborted iteration
+                    gs.undo()
+                gs.get_valid_moves  # restores the checkmate / stalemate flags of the root
+                if best_move is None:  # depth 1 ran out, its best root move so far beats none
+                    best_move, best_score = self.next_move, self.next_score
+                break
+            best_move, best_score = self.next_move, score
+            self.completed_iterations.append((depth, best_move, score))
+            self.iteration_nodes.append(self.nodes - sum(self.iteration_nodes))
+            self.completed_depth = depth
+            if self.iteration_callback is not None:
+                self.iteration_callback(depth, best_move, score)
+            if abs(score) >= CHECKMATE or self.out_of_budget():
+                break
+        return best_move, best_score
+
+    def _search_parallel(self, gs, valid_moves, time_limit, nodes, depth):
+        """
+        splits the root moves between worker processes, each runs iterative deepening on its share
+        :return: (best move, score) at the deepest depth every worker completed
+        """
+        if self.pool is None:
+            self.pool_stop = multiprocessing.Event()
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                            initargs=(self.pool_stop,))
+        self.pool_stop.clear()
+        if self.stop_requested:  # stopped before the processes could see it
+            self.pool_stop.set()
+        self.new_search()
+
+        # deal the ordered root moves round robin so every worker gets good and bad candidates
+        ordered = self.order_moves(valid_moves)
+        shares = [ordered[i::self.workers] for i in range(self.workers)]
+        packed = gs.pack_position()
+        futures = [self.pool.submit(_search_share, type(gs), packed, [move.move_id for move in share], time_limit,
+                                    nodes, depth) for share in shares if share]
+        results = [future.result() for future in futures]
+        self.nodes = sum(worker_nodes for worker_nodes, _ in results)
+
+        # a worker stopped during depth 1 reports depth 0, compare every worker at the depth all completed
+        common_depth = min(iterations[-1][0] for _, iterations in results)
+        best = None
+        for _, iterations in results:
+            if iterations[-1][2] >= CHECKMATE:  # a forced mate needs no comparison
+                best = iterations[-1]
+                break
+            entry = ([iteration for iteration in iterations if iteration[0] <= common_depth] or iterations[:1])[-1]
+            if entry[1] is not None and (best is None or entry[2] > best[2]):
+                best = entry
+        self.completed_depth = common_depth
+        self.split_pv = [] if best is None else best[3]
+        for move in valid_moves:
+            if best is not None and move.move_id == best[1]:
+                return move, best[2]
+        return None, 0
+
+    def moves_from_ids(self, gs, move_ids):
+        """
+        :return: the moves of a line of move_ids played from gs, up to the first one that is not legal
+        """
+        line = []
+        for move_id in move_ids:
+            move = next((move for move in gs.get_valid_moves if move.move_id == move_id), None)
+            if move is None:
+                break
+            gs.make_move(move)
+            line.append(move)
+        for _ in line:
+            gs.undo()
+        gs.get_valid_moves  # restores the checkmate / stalemate flags of gs
+        return line
+
+    def close(self):
+        """
+        shuts the worker processes of the root splitting search down
+        """
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+            self.pool_stop = None
+
+    def out_of_budget(self):
+        return self.stop_requested or (self.stop_event is not None and self.stop_event.is_set()) or \
+            (self.deadline is not None and time.time() >= self.deadline) or \
+            (self.node_limit is not None and self.nodes >= self.node_limit)
+
+    def stats(self):
+        """
+        :return: dict of the counters of the last search; when it ran with profile=True also the cumulative
+                 seconds spent in the PROFILED_FUNCTIONS (nested calls count in each) and the functions
+                 with the most own time
+        """
+        main_nodes = self.nodes - self.quiescence_nodes
+        iteration_nodes = self.iteration_nodes
+        stats = {
+            "nodes": self.nodes,
+            "main_nodes": main_nodes,
+            "leaf_nodes": self.leaf_nodes,
+            "quiescence_nodes": self.quiescence_nodes,
+            "seconds": round(self.seconds, 6),
+            "nps": round(self.nodes / self.seconds) if self.seconds else 0,
+            "depth": self.completed_depth,
+            "iteration_nodes": list(iteration_nodes),
+            "effective_branching_factor":
+                round(iteration_nodes[-1] / iteration_nodes[-2], 3)
+                if len(iteration_nodes) > 1 and iteration_nodes[-2] else None,
+            "cutoffs": self.cutoffs,
+            "cutoff_rate": round(self.cutoffs / (main_nodes - self.leaf_nodes), 4)
+            if main_nodes > self.leaf_nodes else 0,
+            "first_move_cutoff_rate": round(self.first_move_cutoff_rate(), 4),
+            "tt_probes": self.tt_probes,
+            "tt_hit_rate": round(self.tt_hits / self.tt_probes, 4) if self.tt_probes else 0,
+            "tablebase_hits": self.tablebase_hits,
+        }
+        if self.profile is not None:
+            profile = pstats.Stats(self.profile).stats  # (file, line, name) -> (calls, calls, own, cumulative, ...)
+            cumulative = {}
+            for (_, _, name), (_, calls, own_time, cumulative_time, _) in profile.items():
+                if name in PROFILED_FUNCTIONS and cumulative_time > cumulative.get(name, 0):
+                    cumulative[name] = cumulative_time  # an override calling super() keeps the outer, larger time
+            stats["cumulative_seconds"] = {name: round(seconds, 6) for name, seconds in cumulative.items()}
+            top = sorted(profile.items(), key=lambda item: -item[1][2])[:20]
+            stats["profile"] = [{"function": "%s:%d(%s)" % (os.path.basename(file), line, name), "calls": calls,
+                                 "own_seconds": round(own_time, 6), "cumulative_seconds": round(cumulative_time, 6)}
+                                for (file, line, name), (_, calls, own_time, cumulative_time, _) in top]
+        return stats
+
+    def first_move_cutoff_rate(self):
+        """
+        :return: share of the beta cutoffs of the last search that happened on the first move, 0 without cutoffs
+        """
+        return self.first_move_cutoffs / self.cutoffs if self.cutoffs else 0
+
+    def principal_variation(self, gs, move, max_length=MAX_DEPTH):
+        """
+        :return: list of moves starting with move and continued by the best moves the transposition table holds
+        """
+        line = [move]
+        seen = set()
+        made = 0
+        while len(line) < max_length:
+            gs.make_move(line[-1])
+            made += 1
+            if gs.zobrist_key in seen:
+                break  # the stored moves go round in a cycle
+            seen.add(gs.zobrist_key)
+            entry = self.transposition_table.probe(gs.zobrist_key)
+            next_in_line = None
+            if entry is not None and entry[4] is not None:
+                next_in_line = next((reply for reply in gs.get_valid_moves if reply.move_id == entry[4]), None)
+            if next_in_line is None:
+                break
+            line.append(next_in_line)
+        for _ in range(made):
+            gs.undo()
+        return line
+
+    def nega_max_alpha_beta(self, gs, valid_moves, depth, alpha, beta, turn_multiplier):
+        self.nodes += 1
+        if self.nodes & 255 == 0 and self.out_of_budget() and (self.search_depth > 1 or self.next_move is not None):
+            raise SearchTimeout  # depth 1 runs until it has a root move to fall back on
+        if gs.check_mate or gs.stale_mate:
+            return turn_multiplier * score_board(gs)
+        if self.tablebases is not None and depth != self.search_depth and \
+                len(gs.piece_squares["w"]) + len(gs.piece_squares["b"]) <= self.tablebases.max_pieces:
+            result = self.tablebases.probe(gs)
+            if result is not None:
+                self.tablebase_hits += 1
+                return tablebase_score(*result)
+        if depth == 0:
+            self.leaf_nodes += 1
+            return self.quiescence(gs, alpha, beta, turn_multiplier)
+
+        alpha_orig = alpha
+        tt_move_id = None
+        self.tt_probes += 1
+        entry = self.transposition_table.probe(gs.zobrist_key)
+        if entry is not None:
+            self.tt_hits += 1
+            if entry[1] >= depth and depth != self.search_depth:  # the root has to search to set next_move
+                if entry[3] == EXACT:
+                    return entry[2]
+                elif entry[3] == LOWER_BOUND:
+                    alpha = max(alpha, entry[2])
+                else:
+                    beta = min(beta, entry[2])
+                if alpha >= beta:
+                    return entry[2]
+            tt_move_id = entry[4]
+        ply = self.search_depth - depth
+        if ply == 0 and self.root_move is not None:
+            tt_move_id = self.root_move
+        valid_moves = self.order_moves(valid_moves, tt_move_id, ply)
+
+        max_score = -CHECKMATE
+        best_move = None
+        for i in range(len(valid_moves)):
+            move = valid_moves[i]
+            gs.make_move(move)
+            nm = gs.get_valid_moves
+            score = - self.nega_max_alpha_beta(gs, nm, depth - 1, -beta, -alpha, -turn_multiplier)
+            gs.undo()
+            if score > max_score:
+                max_score = score
+                best_move = move
+                if depth == self.search_depth:
+                    self.next_move = move
+                    self.next_score = score
+            alpha = max(alpha, max_score)
+            if alpha >= beta:
+                self.cutoffs += 1
+                if i == 0:
+                    self.first_move_cutoffs += 1
+                if move.piece_capture == "--" and not move.is_pawn_promotion:
+                    # quiet move refuted this line, try it early in sibling nodes and in later searches
+                    killers = self.killer_moves[ply]
+                    if killers[0] != move.move_id:
+                        killers.insert(0, move.move_id)
+                        killers.pop()
+                    self.history[move.move_id] = self.history.get(move.move_id, 0) + depth * depth
+                break
+
+        if max_score <= alpha_orig:
+            flag = UPPER_BOUND
+        elif max_score >= beta:
+            flag = LOWER_BOUND
+        else:
+            flag = EXACT
+        self.transposition_table.store(gs.zobrist_key, depth, max_score, flag,
+                                       None if best_move is None else best_move.move_id)
+        return max_score
+
+    def quiescence(self, gs, alpha, beta, turn_multiplier, ply=0):
+        """
+        searches captures and promotions until the position is quiet, every move when in check at the
+        first quiescence ply, at most QUIESCENCE_PLIES deep
+        :return: score from the side to move's point of view
+        """
+        self.nodes += 1
+        self.quiescence_nodes += 1
+        if self.nodes & 255 == 0 and self.out_of_budget() and (self.search_depth > 1 or self.next_move is not None):
+            raise SearchTimeout
+        evading = ply == 0 and gs.in_check()
+        if evading:
+            moves = gs.get_capture_moves
+            if len(moves) == 0:
+                return -CHECKMATE
+            stand_pat = -CHECKMATE  # no standing pat while in check, every evasion is searched
+        else:
+            # the side to move can always decline the captures, deeper checks are not followed;
+            # standing pat is decided before any move is generated
+            stand_pat = turn_multiplier * gs.score
+            if stand_pat >= beta or ply >= QUIESCENCE_PLIES:
+                return stand_pat
+            alpha = max(alpha, stand_pat)
+            moves = gs.get_capture_moves
+            if len(moves) == 0 and gs.in_check():  # every evasion was generated, there is none
+                return -CHECKMATE
+
+        max_score = stand_pat
+        for move in self.order_moves(moves):
+            if not evading:
+                if move.piece_capture == "--" and not move.is_pawn_promotion:
+                    continue  # a quiet evasion of a check found below the first ply
+                # delta pruning, skip captures that can not bring the score back up to alpha
+                placed = move.piece_move[0] + move.promotion_piece if move.is_pawn_promotion else move.piece_move
+                gain = abs(square_scores[placed][move.end_row][move.end_col]) - \
+                    abs(square_scores[move.piece_move][move.start_row][move.start_col])
+                if move.piece_capture != "--":
+                    gain += abs(square_scores[move.piece_capture][move.end_row][move.end_col])
+                if stand_pat + gain + DELTA_MARGIN < alpha:
+                    continue
+                # a bigger piece taking a smaller defended one most likely loses the exchange
+                if move.piece_capture != "--" and not move.is_pawn_promotion and \
+                        ORDER_VALUES[move.piece_move[1]] > ORDER_VALUES[move.piece_capture[1]] and \
+                        gs.square_under_attack(move.end_row, move.end_col):
+                    continue
+            gs.make_move(move)
+            score = -self.quiescence(gs, -beta, -alpha, -turn_multiplier, ply + 1)
+            gs.undo()
+            if score > max_score:
+                max_score = score
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+        return max_score
+
+    def move_order(self, move, tt_move_id=None, ply=None):
+        """
+        :return: sort key of the move, higher is searched earlier
+        transposition table move, then captures by most valuable victim / least valuable attacker,
+        promotions, killer moves of the ply and finally quiet moves by history
+        """
+        if move.move_id == tt_move_id:
+            return TT_MOVE_ORDER
+        if move.piece_capture != "--":
+            score = CAPTURE_ORDER + 10 * ORDER_VALUES[move.piece_capture[1]] - ORDER_VALUES[move.piece_move[1]]
+            if move.is_pawn_promotion:
+                score += ORDER_VALUES[move.promotion_piece]
+            return score
+        if move.is_pawn_promotion:
+            return CAPTURE_ORDER + ORDER_VALUES[move.promotion_piece]
+        if ply is not None and move.move_id in self.killer_moves[ply]:
+            return KILLER_ORDER - self.killer_moves[ply].index(move.move_id)
+        return self.history.get(move.move_id, 0)
+
+    def order_moves(self, moves, tt_move_id=None, ply=None):
+        """
+        :param ply: distance from the root, None to skip killer moves (quiescence)
+        :return: moves sorted best first
+        """
+        return sorted(moves, key=lambda move: self.move_order(move, tt_move_id, ply), reverse=True)
+
+
+_worker_searcher = None  # Searcher of a root splitting worker process, its table stays warm between moves
+_worker_stop = None  # the pool_stop Event of the Searcher that created the worker process
+
+
+def _init_worker(stop_event):
+    global _worker_stop
+    _worker_stop = stop_event
+
+
+def _search_share(state_class, packed, root_move_ids, time_limit, nodes, depth):
+    """
+    runs in a worker process: loads the packed position and searches only the given root moves
+    :return: (nodes searched, list of (depth, move_id, score, principal variation move_ids) of the completed
+             iterations, only the last one has more than its move in the variation; a single depth 0 entry
+             when the search was stopped during depth 1)
+    """
+    global _worker_searcher
+    if _worker_searcher is None:
+        _worker_searcher = Searcher()
+    _worker_searcher.stop_event = _worker_stop
+    gs = state_class()
+    gs.load_packed(packed)
+    root_moves = [move for move in gs.get_valid_moves if move.move_id in root_move_ids]
+    result = _worker_searcher.search(gs, root_moves, time_limit, nodes, depth)
+    iterations = [(depth, None if move is None else move.move_id, score, [] if move is None else [move.move_id])
+                  for depth, move, score in _worker_searcher.completed_iterations]
+    if not iterations:
+        iterations = [(0, None if result.move is None else result.move.move_id, result.score, [])]
+    iterations[-1] = iterations[-1][:3] + ([move.move_id for move in result.pv],)
+    return _worker_searcher.nodes, iterations
+
+
+class BackgroundSearch:
+    """
+    Runs one search at a time on a daemon thread of its own copy of the position, so the caller's
+    loop keeps handling events. result is (zobrist key, move_id, expected reply move_id) once it is done.
+    A pondering search has no time limit until ponder_hit gives it one.
+    """
+
+    def __init__(self, state_class, workers=1, time_limit=TIME_LIMIT):
+        self.state_class = state_class
+        self.searcher = Searcher(workers=workers)
+        self.time_limit = time_limit
+        self.thread = None
+        self.key = None  # zobrist key of the position searched, None after cancel
+        self.result = None
+        self.pondering = False
+        self.stop_at = None  # time.time() a pondering search is stopped at after a ponder hit
+
+    @property
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    @property
+    def done(self):
+        return self.result is not None and not self.busy
+
+    def start(self, gs, ponder_move_id=None):
+        """
+        searches gs, or with ponder_move_id the position after that move until ponder_hit or cancel
+        the previous search has to be finished, see busy
+        """
+        state = self.state_class()
+        state.load_packed(gs.pack_position())
+        if ponder_move_id is not None:
+            ponder_move = next((move for move in state.get_valid_moves if move.move_id == ponder_move_id), None)
+            if ponder_move is None:
+                return  # stale table entry, nothing to ponder on
+            state.make_move(ponder_move)
+        self.key = state.zobrist_key
+        self.result = None
+        self.pondering = ponder_move_id is not None
+        self.stop_at = None
+        self.searcher.stop_requested = False
+        self.thread = threading.Thread(target=self._run, args=(state, self.key), daemon=True)
+        self.thread.start()
+
+    def _run(self, state, key):
+        valid_moves = state.get_valid_moves
+        if len(valid_moves) == 0:
+            return
+        result = self.searcher.search(state, valid_moves, None if self.pondering else self.time_limit)
+        move = result.move if result.move is not None else random_move(valid_moves)
+        reply = result.pv[1].move_id if result.move is move and len(result.pv) > 1 else None
+        self.result = (key, move.move_id, reply)
+
+    def ponder_hit(self):
+        """
+        the predicted move was played, the pondering search goes on for the normal time limit
+        """
+        self.pondering = False
+        self.stop_at = time.time() + self.time_limit
+
+    def check_time(self):
+        """
+        called by the polling loop, stops a search that was pondering once its time after the ponder hit is up
+        """
+        if self.stop_at is not None and self.busy and time.time() >= self.stop_at:
+            self.searcher.stop()
+
+    def cancel(self):
+        """
+        aborts the running search and drops its result, the thread ends within a few hundred nodes
+        """
+        self.searcher.stop()
+        self.key = None
+        self.result = None
+        self.pondering = False
+        self.stop_at = None
 
 
 def score_board(gs):
@@ -135,46 +662,15 @@ def score_board(gs):
     elif gs.stale_mate:
         return STALEMATE
 
-    score = 0
-    for row in range(len(gs.board)):
-        for col in range(len((gs.board[row]))):
-            box = gs.board[row][col]
-            if box != "--":
-                piece_position_score = 0
-                if box[1] != "K":
-                    if box[1] == "P":
-                        piece_position_score = piece_position_scores[box][row][col]
-                    else:
-                        piece_position_score = piece_position_scores[box[1]][row][col]
-
-                if box[0] == "w":
-                    score += piece_score[box[1]] + piece_position_score * 10
-
-                elif box[0] == "b":
-                    score -= piece_score[box[1]] + piece_position_score * 10
-
-    return score
+    return gs.score  # kept up to date by make_move/undo
 
 
-def score_material(board):
+def score_material(gs):
     score = 0
-    for row in board:
-        for box in row:
-            if box[0] == "w":
-                score += piece_score[box[1]]
-            elif box[0] == "b":
-                score -= piece_score[box[1]]
+    for row, col in gs.piece_squares["w"]:
+        score += piece_score[gs.board[row][col][1]]
+    for row, col in gs.piece_squares["b"]:
+        score -= piece_score[gs.board[row][col][1]]
 
     return score
 
-
-def move_order(move):
-    score = 0
-    if move.piece_capture != '--':
-        score += piece_score[move.piece_capture[1]]
-        if move.is_pawn_promotion:
-            score += piece_score['Q']
-    elif move.is_castle_move:
-        score += piece_score['K'] + piece_score['R']
-
-    return score
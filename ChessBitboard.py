@@ -0,0 +1,710 @@
+"""
+This Class is responsible for:
+ holding the position on bitboards alone (BitboardPosition: one 64-bit integer per piece, integer moves,
+ its own make_move/undo), generating the legal moves from precomputed attack tables,
+ counting the legal moves without listing them (perft bulk counting),
+ exposing the same get_valid_moves/make_move/undo surface as ChessEngine.GameState (BitboardGameState),
+ which converts to ChessEngine.Move only at that edge, for the GUI and the search.
+
+Square index is row * 8 + col, so bit 0 is a8 and bit 63 is h1 (same orientation as GameState.board).
+
+Measured with ChessPerft.py --depth 4 over its whole suite: BitboardPosition 1.8-2.1M nodes/sec against
+290-300k for the list generator. BitboardGameState still builds a Move per legal move and updates the string
+board, so behind it the search gains little (ChessProfile.py --depth 3: 15-18k against 14-16k nodes/sec).
+"""
+
+from ChessEngine import (GameState, Move, CASTLING_MASKS, PROMOTION_PIECES, ZOBRIST_BLACK_TURN, ZOBRIST_CASTLING,
+                         ZOBRIST_EN_PASSANT, ZOBRIST_PIECES, WHITE_KING_SIDE, WHITE_QUEEN_SIDE, BLACK_KING_SIDE,
+                         BLACK_QUEEN_SIDE)
+from ChessScores import square_scores
+
+PIECES = ["wP", "wN", "wB", "wR", "wQ", "wK", "bP", "bN", "bB", "bR", "bQ", "bK"]
+
+SQUARES = [(sq // 8, sq % 8) for sq in range(64)]
+
+# (row, col) steps; directions whose square index increases are scanned with the lowest set bit
+ORTHOGONAL = ((0, 1), (1, 0), (0, -1), (-1, 0))
+DIAGONAL = ((1, 1), (1, -1), (-1, 1), (-1, -1))
+
+
+def _step_mask(sq, steps):
+    r, c = SQUARES[sq]
+    mask = 0
+    for dr, dc in steps:
+        if 0 <= r + dr < 8 and 0 <= c + dc < 8:
+            mask |= 1 << ((r + dr) * 8 + c + dc)
+    return mask
+
+
+def _ray(sq, dr, dc):
+    r, c = SQUARES[sq]
+    mask = 0
+    r, c = r + dr, c + dc
+    while 0 <= r < 8 and 0 <= c < 8:
+        mask |= 1 << (r * 8 + c)
+        r, c = r + dr, c + dc
+    return mask
+
+
+KNIGHT_ATTACKS = [_step_mask(sq, ((-2, -1), (-2, 1), (2, 1), (2, -1), (-1, -2), (1, -2), (1, 2), (-1, 2)))
+                  for sq in range(64)]
+KING_ATTACKS = [_step_mask(sq, ((1, 0), (-1, 0), (1, 1), (1, -1), (-1, -1), (-1, 1), (0, -1), (0, 1)))
+                for sq in range(64)]
+# squares attacked by a pawn of the given color standing on sq
+PAWN_ATTACKS = {"w": [_step_mask(sq, ((-1, -1), (-1, 1))) for sq in range(64)],
+                "b": [_step_mask(sq, ((1, -1), (1, 1))) for sq in range(64)]}
+# (ray table, scans towards higher square index)
+ROOK_RAYS = [([_ray(sq, dr, dc) for sq in range(64)], dr * 8 + dc > 0) for dr, dc in ORTHOGONAL]
+BISHOP_RAYS = [([_ray(sq, dr, dc) for sq in range(64)], dr * 8 + dc > 0) for dr, dc in DIAGONAL]
+
+
+def _between_table():
+    """
+    :return: table[a][b] of the squares strictly between a and b on a common line, 0 otherwise
+    """
+    table = [[0] * 64 for _ in range(64)]
+    for rays, _ in ROOK_RAYS + BISHOP_RAYS:
+        for a in range(64):
+            line = rays[a]
+            while line:
+                bit = line & -line
+                b = bit.bit_length() - 1
+                table[a][b] = rays[a] & ~rays[b] & ~bit
+                line ^= bit
+    return table
+
+
+BETWEEN = _between_table()
+
+
+def _slide(sq, occupied, rays):
+    attacks = 0
+    for table, positive in rays:
+        ray = table[sq]
+        blockers = ray & occupied
+        if blockers:
+            if positive:
+                ray ^= table[(blockers & -blockers).bit_length() - 1]
+            else:
+                ray ^= table[blockers.bit_length() - 1]
+        attacks |= ray
+    return attacks
+
+
+def _line_tables(rays):
+    """
+    kindergarten style lookup of one line (two opposite rays) through every square
+    :return: (masks, attacks), masks[sq] are the squares of the line that can block, the edges never do,
+             attacks[sq] maps the blockers on that mask to the attacked squares of the line
+    """
+    masks = []
+    attacks = []
+    for sq in range(64):
+        mask = 0
+        for table, positive in rays:
+            ray = table[sq]
+            if ray:
+                mask |= ray ^ (1 << (ray.bit_length() - 1) if positive else ray & -ray)
+        lookup = {}
+        subset = 0
+        while True:  # every subset of the mask, carry-rippler
+            lookup[subset] = _slide(sq, subset, rays)
+            subset = (subset - mask) & mask
+            if not subset:
+                break
+        masks.append(mask)
+        attacks.append(lookup)
+    return masks, attacks
+
+
+RANK_MASKS, RANK_ATTACKS = _line_tables([ROOK_RAYS[0], ROOK_RAYS[2]])
+FILE_MASKS, FILE_ATTACKS = _line_tables([ROOK_RAYS[1], ROOK_RAYS[3]])
+DIAGONAL_MASKS, DIAGONAL_ATTACKS = _line_tables([BISHOP_RAYS[0], BISHOP_RAYS[3]])
+ANTI_DIAGONAL_MASKS, ANTI_DIAGONAL_ATTACKS = _line_tables([BISHOP_RAYS[1], BISHOP_RAYS[2]])
+
+
+def rook_attacks(sq, occupied):
+    return RANK_ATTACKS[sq][occupied & RANK_MASKS[sq]] | FILE_ATTACKS[sq][occupied & FILE_MASKS[sq]]
+
+
+def bishop_attacks(sq, occupied):
+    return DIAGONAL_ATTACKS[sq][occupied & DIAGONAL_MASKS[sq]] | \
+        ANTI_DIAGONAL_ATTACKS[sq][occupied & ANTI_DIAGONAL_MASKS[sq]]
+
+
+def squares(bb):
+    """
+    :param bb: bitboard
+    :return: square indexes of the set bits
+    """
+    while bb:
+        bit = bb & -bb
+        yield bit.bit_length() - 1
+        bb ^= bit
+
+
+# piece index into BitboardPosition.pieces, same order as PIECES, black pieces are BLACK + piece type
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+BLACK = 6
+EMPTY = -1
+
+FULL = (1 << 64) - 1
+FILE_A = sum(1 << (row * 8) for row in range(8))
+NOT_FILE_A = FULL ^ FILE_A
+NOT_FILE_H = FULL ^ (FILE_A << 7)
+ROWS = [0xFF << (row * 8) for row in range(8)]
+
+# integer moves: start | end << 6 | promotion << 12 | flags, promotion is 1 + index in PROMOTION_PIECES, 0 otherwise
+PROMOTION_SHIFT = 12
+EN_PASSANT_FLAG = 1 << 15
+CASTLE_FLAG = 1 << 16
+PROMOTION_TYPES = [EMPTY] + ["PNBRQK".index(piece) for piece in PROMOTION_PIECES]
+PROMOTIONS = [(index + 1) << PROMOTION_SHIFT for index in range(len(PROMOTION_PIECES))]
+
+# the ChessEngine tables flattened to square indexes, so both backends hash and score a position alike
+ZOBRIST = [[ZOBRIST_PIECES[piece][row][col] for row, col in SQUARES] for piece in PIECES]
+SCORES = [[square_scores[piece][row][col] for row, col in SQUARES] for piece in PIECES]
+CASTLING_MASK = [CASTLING_MASKS[row][col] for row, col in SQUARES]
+# PAWN_ATTACKS by side, 0 white and 1 black
+SIDE_PAWN_ATTACKS = [PAWN_ATTACKS["w"], PAWN_ATTACKS["b"]]
+# slider attacks on an empty board, to skip the ray scan when no slider is on a line through the square
+ROOK_LINES = [rook_attacks(sq, 0) for sq in range(64)]
+BISHOP_LINES = [bishop_attacks(sq, 0) for sq in range(64)]
+
+
+def move_notation(move):
+    """
+    :return: chess notation of an integer move, e.g. "e7e8q"
+    """
+    notation = Move.cols_to_files[move & 7] + Move.rows_to_ranks[move >> 3 & 7] + \
+        Move.cols_to_files[move >> 6 & 7] + Move.rows_to_ranks[move >> 9 & 7]
+    promotion = move >> PROMOTION_SHIFT & 7
+    if promotion:
+        notation += PROMOTION_PIECES[promotion - 1].lower()
+    return notation
+
+
+def move_id(move):
+    """
+    :return: ChessEngine.Move.move_id of an integer move
+    """
+    return (move >> PROMOTION_SHIFT & 7) * 10000 + (move >> 3 & 7) * 1000 + (move & 7) * 100 + \
+        (move >> 9 & 7) * 10 + (move >> 6 & 7)
+
+
+def from_move(move):
+    """
+    :param move: ChessEngine.Move
+    :return: the same move as an integer move
+    """
+    encoded = move.start_row * 8 + move.start_col | (move.end_row * 8 + move.end_col) << 6
+    if move.is_pawn_promotion:
+        encoded |= (PROMOTION_PIECES.index(move.promotion_piece) + 1) << PROMOTION_SHIFT
+    if move.is_en_passant_move:
+        encoded |= EN_PASSANT_FLAG
+    if move.is_castle_move:
+        encoded |= CASTLE_FLAG
+    return encoded
+
+
+class BitboardPosition:
+    """
+    The position on bitboards alone, moves are integers and make_move/undo only touch the bitboards,
+    a square -> piece array, the castling rights, the en passant square, the zobrist key and the score.
+    """
+
+    def __init__(self, gs=None):
+        """
+        :param gs: ChessEngine.GameState to copy the position from, the start position when None
+        """
+        self.load_game_state(gs if gs is not None else GameState())
+
+    def load_game_state(self, gs):
+        """
+        pieces -- 12 bitboards indexed like PIECES
+        occupied -- [white, black] occupancy
+        board -- piece index on each square, EMPTY when there is none
+        side -- 0 white to move, 1 black to move
+        history -- (move, captured piece, castling rights, en passant, zobrist key, score) before each made move
+        pinned -- own pieces pinned to the king, set by the last move generation
+        """
+        self.pieces = [0] * 12
+        self.occupied = [0, 0]
+        self.board = [EMPTY] * 64
+        for sq, (row, col) in enumerate(SQUARES):
+            piece = gs.board[row][col]
+            if piece != "--":
+                index = PIECES.index(piece)
+                self.pieces[index] |= 1 << sq
+                self.occupied[index // BLACK] |= 1 << sq
+                self.board[sq] = index
+        self.side = 0 if gs.white_turn else 1
+        self.castling_rights = gs.castling_rights
+        self.en_passant = gs.en_passant_possible[0] * 8 + gs.en_passant_possible[1] if gs.en_passant_possible else -1
+        self.zobrist_key = gs.zobrist_key
+        self.score = gs.score
+        self.history = []
+        self.pinned = 0
+
+    def load_fen(self, fen):
+        """
+        sets up the position from a FEN, validated by GameState.load_fen
+        """
+        gs = GameState()
+        gs.load_fen(fen)
+        self.load_game_state(gs)
+
+    def en_passant_key(self):
+        """
+        :return: zobrist key of the en passant column, following GameState.en_passant_key
+        """
+        if self.en_passant >= 0 and \
+                SIDE_PAWN_ATTACKS[1 - self.side][self.en_passant] & self.pieces[BLACK * self.side + PAWN]:
+            return ZOBRIST_EN_PASSANT[self.en_passant & 7]
+        return 0
+
+    def make_move(self, move):
+        """
+        :param move: legal integer move
+        """
+        pieces = self.pieces
+        board = self.board
+        side = self.side
+        start = move & 63
+        end = move >> 6 & 63
+        piece = board[start]
+        captured = board[end]
+        self.history.append((move, captured, self.castling_rights, self.en_passant, self.zobrist_key, self.score))
+        key = self.zobrist_key ^ ZOBRIST_BLACK_TURN ^ ZOBRIST_CASTLING[self.castling_rights] ^ self.en_passant_key()
+
+        start_bit = 1 << start
+        end_bit = 1 << end
+        placed = piece
+        if move >> PROMOTION_SHIFT & 7:
+            placed = BLACK * side + PROMOTION_TYPES[move >> PROMOTION_SHIFT & 7]
+        pieces[piece] ^= start_bit
+        pieces[placed] ^= end_bit
+        self.occupied[side] ^= start_bit | end_bit
+        board[start] = EMPTY
+        board[end] = placed
+        key ^= ZOBRIST[piece][start] ^ ZOBRIST[placed][end]
+        score = self.score - SCORES[piece][start] + SCORES[placed][end]
+
+        if captured != EMPTY:
+            pieces[captured] ^= end_bit
+            self.occupied[1 - side] ^= end_bit
+            key ^= ZOBRIST[captured][end]
+            score -= SCORES[captured][end]
+        elif move & EN_PASSANT_FLAG:
+            sq = end + 8 if side == 0 else end - 8
+            captured = BLACK - BLACK * side + PAWN
+            pieces[captured] ^= 1 << sq
+            self.occupied[1 - side] ^= 1 << sq
+            board[sq] = EMPTY
+            key ^= ZOBRIST[captured][sq]
+            score -= SCORES[captured][sq]
+        elif move & CASTLE_FLAG:
+            rook_start, rook_end = (end + 1, end - 1) if end > start else (end - 2, end + 1)
+            rook = BLACK * side + ROOK
+            rook_bits = 1 << rook_start | 1 << rook_end
+            pieces[rook] ^= rook_bits
+            self.occupied[side] ^= rook_bits
+            board[rook_start] = EMPTY
+            board[rook_end] = rook
+            key ^= ZOBRIST[rook][rook_start] ^ ZOBRIST[rook][rook_end]
+            score += SCORES[rook][rook_end] - SCORES[rook][rook_start]
+
+        if piece == BLACK * side + PAWN and (end - start == 16 or start - end == 16):
+            self.en_passant = (start + end) >> 1
+        else:
+            self.en_passant = -1
+        self.castling_rights &= CASTLING_MASK[start] & CASTLING_MASK[end]
+        self.side = 1 - side
+        self.zobrist_key = key ^ self.en_passant_key() ^ ZOBRIST_CASTLING[self.castling_rights]
+        self.score = score
+
+    def undo(self):
+        """
+        takes back the last made move
+        """
+        move, captured, self.castling_rights, self.en_passant, self.zobrist_key, self.score = self.history.pop()
+        pieces = self.pieces
+        board = self.board
+        side = self.side = 1 - self.side
+        start = move & 63
+        end = move >> 6 & 63
+        placed = board[end]
+        piece = BLACK * side + PAWN if move >> PROMOTION_SHIFT & 7 else placed
+        start_bit = 1 << start
+        end_bit = 1 << end
+        pieces[placed] ^= end_bit
+        pieces[piece] ^= start_bit
+        self.occupied[side] ^= start_bit | end_bit
+        board[start] = piece
+        board[end] = captured
+
+        if captured != EMPTY:
+            pieces[captured] ^= end_bit
+            self.occupied[1 - side] ^= end_bit
+        elif move & EN_PASSANT_FLAG:
+            sq = end + 8 if side == 0 else end - 8
+            captured = BLACK - BLACK * side + PAWN
+            pieces[captured] ^= 1 << sq
+            self.occupied[1 - side] ^= 1 << sq
+            board[sq] = captured
+        elif move & CASTLE_FLAG:
+            rook_start, rook_end = (end + 1, end - 1) if end > start else (end - 2, end + 1)
+            rook = BLACK * side + ROOK
+            rook_bits = 1 << rook_start | 1 << rook_end
+            pieces[rook] ^= rook_bits
+            self.occupied[side] ^= rook_bits
+            board[rook_start] = rook
+            board[rook_end] = EMPTY
+
+    def attackers(self, sq, side, occupied):
+        """
+        :param sq: square index
+        :param side: 0 or 1, side whose pieces attack
+        :param occupied: occupancy used to block sliders, pieces outside it are ignored
+        :return: bitboard of the side's pieces attacking sq
+        """
+        pieces = self.pieces
+        base = BLACK * side
+        found = (KNIGHT_ATTACKS[sq] & pieces[base + KNIGHT] | KING_ATTACKS[sq] & pieces[base + KING]
+                 | SIDE_PAWN_ATTACKS[1 - side][sq] & pieces[base + PAWN])
+        queens = pieces[base + QUEEN]
+        diagonal = (pieces[base + BISHOP] | queens) & BISHOP_LINES[sq]
+        if diagonal:  # bishop_attacks and rook_attacks inlined, this runs for every king step and castle square
+            found |= (DIAGONAL_ATTACKS[sq][occupied & DIAGONAL_MASKS[sq]]
+                      | ANTI_DIAGONAL_ATTACKS[sq][occupied & ANTI_DIAGONAL_MASKS[sq]]) & diagonal
+        straight = (pieces[base + ROOK] | queens) & ROOK_LINES[sq]
+        if straight:
+            found |= (RANK_ATTACKS[sq][occupied & RANK_MASKS[sq]]
+                      | FILE_ATTACKS[sq][occupied & FILE_MASKS[sq]]) & straight
+        return found & occupied
+
+    def in_check(self):
+        """
+        :return: side to move is in check
+        """
+        king = self.pieces[BLACK * self.side + KING].bit_length() - 1
+        return self.attackers(king, 1 - self.side, self.occupied[0] | self.occupied[1]) != 0
+
+    @property
+    def get_valid_moves(self):
+        """
+        :return: legal integer moves
+        """
+        return self._get_legal_moves(False)
+
+    @property
+    def get_capture_moves(self):
+        """
+        :return: legal captures and promotions, or every legal move when the king is in check
+        """
+        return self._get_legal_moves(True)
+
+    def count_valid_moves(self):
+        """
+        :return: number of legal moves, counted on the bitboards without listing the unpinned piece moves
+        """
+        moves, target, push_target = self._special_moves(False)
+        count = len(moves)
+        if not target:
+            return count
+        pieces = self.pieces
+        side = self.side
+        base = BLACK * side
+        occupied = self.occupied[0] | self.occupied[1]
+        free = FULL ^ self.pinned
+        bb = pieces[base + KNIGHT] & free
+        while bb:
+            bit = bb & -bb
+            count += (KNIGHT_ATTACKS[bit.bit_length() - 1] & target).bit_count()
+            bb ^= bit
+        queens = pieces[base + QUEEN]
+        bb = (pieces[base + BISHOP] | queens) & free
+        while bb:
+            bit = bb & -bb
+            sq = bit.bit_length() - 1
+            count += ((DIAGONAL_ATTACKS[sq][occupied & DIAGONAL_MASKS[sq]]
+                       | ANTI_DIAGONAL_ATTACKS[sq][occupied & ANTI_DIAGONAL_MASKS[sq]]) & target).bit_count()
+            bb ^= bit
+        bb = (pieces[base + ROOK] | queens) & free
+        while bb:
+            bit = bb & -bb
+            sq = bit.bit_length() - 1
+            count += ((RANK_ATTACKS[sq][occupied & RANK_MASKS[sq]]
+                       | FILE_ATTACKS[sq][occupied & FILE_MASKS[sq]]) & target).bit_count()
+            bb ^= bit
+        for to_squares, _ in self._pawn_sets(pieces[base + PAWN] & free, target, push_target, False):
+            promotions = to_squares & (ROWS[0] | ROWS[7])
+            count += to_squares.bit_count() + 3 * promotions.bit_count()
+        return count
+
+    def perft(self, depth):
+        """
+        :return: number of legal move sequences of length depth, the last ply is counted instead of made
+        """
+        if depth <= 1:
+            return self.count_valid_moves() if depth == 1 else 1
+        nodes = 0
+        for move in self._get_legal_moves(False):
+            self.make_move(move)
+            nodes += self.perft(depth - 1)
+            self.undo()
+        return nodes
+
+    def _get_legal_moves(self, captures_only):
+        """
+        :param captures_only: only captures and promotions, ignored in check
+        """
+        moves, target, push_target = self._special_moves(captures_only)
+        if not target:
+            return moves
+        pieces = self.pieces
+        side = self.side
+        base = BLACK * side
+        occupied = self.occupied[0] | self.occupied[1]
+        free = FULL ^ self.pinned
+        for pieces_bb, attacks in ((pieces[base + KNIGHT] & free, None),
+                                   ((pieces[base + BISHOP] | pieces[base + QUEEN]) & free, bishop_attacks),
+                                   ((pieces[base + ROOK] | pieces[base + QUEEN]) & free, rook_attacks)):
+            while pieces_bb:
+                bit = pieces_bb & -pieces_bb
+                sq = bit.bit_length() - 1
+                to_squares = (KNIGHT_ATTACKS[sq] if attacks is None else attacks(sq, occupied)) & target
+                while to_squares:
+                    to_bit = to_squares & -to_squares
+                    moves.append(sq | (to_bit.bit_length() - 1) << 6)
+                    to_squares ^= to_bit
+                pieces_bb ^= bit
+        for to_squares, delta in self._pawn_sets(pieces[base + PAWN] & free, target, push_target, captures_only):
+            while to_squares:
+                to_bit = to_squares & -to_squares
+                to = to_bit.bit_length() - 1
+                if to_bit & (ROWS[0] | ROWS[7]):
+                    move = to + delta | to << 6
+                    moves.extend([move | promotion for promotion in PROMOTIONS])
+                else:
+                    moves.append(to + delta | to << 6)
+                to_squares ^= to_bit
+        return moves
+
+    def _pawn_sets(self, pawns, target, push_target, captures_only):
+        """
+        :return: (destinations, start - destination) of the pawns, one entry per pawn move direction
+        """
+        empty = FULL ^ (self.occupied[0] | self.occupied[1])
+        enemies = self.occupied[1 - self.side] & target
+        if self.side == 0:
+            one = pawns >> 8 & empty
+            two = 0 if captures_only else (one & ROWS[5]) >> 8 & empty & push_target
+            return ((one & push_target, 8), (two, 16), ((pawns & NOT_FILE_A) >> 9 & enemies, 9),
+                    ((pawns & NOT_FILE_H) >> 7 & enemies, 7))
+        one = pawns << 8 & empty
+        two = 0 if captures_only else (one & ROWS[2]) << 8 & empty & push_target
+        return ((one & push_target, -8), (two, -16), ((pawns & NOT_FILE_A) << 7 & enemies, -7),
+                ((pawns & NOT_FILE_H) << 9 & enemies, -9))
+
+    def _special_moves(self, captures_only):
+        """
+        lists the king, castle, en passant and pinned piece moves and sets self.pinned
+        :return: (moves, target, push_target), the squares the other pieces may capture or move to
+                 and the squares the other pawns may push to, both 0 in double check
+        """
+        pieces = self.pieces
+        side = self.side
+        enemy = 1 - side
+        base = BLACK * side
+        own = self.occupied[side]
+        enemy_pieces = self.occupied[enemy]
+        occupied = own | enemy_pieces
+        king = pieces[base + KING].bit_length() - 1
+        checkers = self.attackers(king, enemy, occupied)
+        captures_only = captures_only and not checkers
+        moves = []
+        self.pinned = 0
+
+        # king moves, the king itself must not block slider rays behind it
+        without_king = occupied ^ (1 << king)
+        to_squares = KING_ATTACKS[king] & (enemy_pieces if captures_only else FULL ^ own)
+        safe = 0
+        while to_squares:
+            to_bit = to_squares & -to_squares
+            to = to_bit.bit_length() - 1
+            if not self.attackers(to, enemy, without_king):
+                moves.append(king | to << 6)
+                safe |= to_bit
+            to_squares ^= to_bit
+        if checkers & (checkers - 1):  # double check, only the king can move
+            return moves, 0, 0
+        if checkers:
+            block = BETWEEN[king][checkers.bit_length() - 1]
+            target, push_target = checkers | block, block
+        elif captures_only:
+            target, push_target = enemy_pieces, ROWS[0] | ROWS[7]
+        else:
+            target, push_target = FULL ^ own, FULL
+            self._get_castle_moves(king, side, occupied, safe, moves)
+
+        # a piece is pinned when it is the only piece between the king and an enemy slider on the same line
+        enemy_base = BLACK * enemy
+        queens = pieces[enemy_base + QUEEN]
+        snipers = ROOK_LINES[king] & (pieces[enemy_base + ROOK] | queens) | \
+            BISHOP_LINES[king] & (pieces[enemy_base + BISHOP] | queens)
+        while snipers:
+            bit = snipers & -snipers
+            snipers ^= bit
+            line = BETWEEN[king][bit.bit_length() - 1]
+            blockers = line & occupied
+            if blockers & own and not blockers & (blockers - 1):
+                self.pinned |= blockers
+                self._pinned_moves(blockers.bit_length() - 1, line | bit, target, push_target, occupied,
+                                   captures_only, moves)
+
+        if self.en_passant >= 0:
+            # en passant removes two pieces from one line, so verify the king directly
+            ep_bit = 1 << self.en_passant
+            captured = self.en_passant + 8 if side == 0 else self.en_passant - 8
+            capturers = SIDE_PAWN_ATTACKS[enemy][self.en_passant] & pieces[base + PAWN]
+            while capturers:
+                bit = capturers & -capturers
+                after = occupied ^ bit ^ (1 << captured) | ep_bit
+                if not self.attackers(king, enemy, after):
+                    moves.append(bit.bit_length() - 1 | self.en_passant << 6 | EN_PASSANT_FLAG)
+                capturers ^= bit
+        return moves, target, push_target
+
+    def _pinned_moves(self, sq, line, target, push_target, occupied, captures_only, moves):
+        """
+        appends the moves of the pinned piece on sq, which has to stay on line
+        """
+        piece = self.board[sq] - BLACK * self.side
+        if piece == KNIGHT:
+            return
+        if piece == PAWN:
+            push_target &= line
+            target &= line
+            forward = -8 if self.side == 0 else 8
+            to_squares = SIDE_PAWN_ATTACKS[self.side][sq] & self.occupied[1 - self.side] & target
+            one = sq + forward
+            if not (1 << one) & occupied:
+                to_squares |= (1 << one) & push_target
+                two = one + forward
+                if not captures_only and sq >> 3 == (6 if self.side == 0 else 1) and not (1 << two) & occupied:
+                    to_squares |= (1 << two) & push_target
+        else:
+            to_squares = 0
+            if piece != ROOK:
+                to_squares |= bishop_attacks(sq, occupied)
+            if piece != BISHOP:
+                to_squares |= rook_attacks(sq, occupied)
+            to_squares &= target & line
+        while to_squares:
+            to_bit = to_squares & -to_squares
+            move = sq | (to_bit.bit_length() - 1) << 6
+            if piece == PAWN and to_bit & (ROWS[0] | ROWS[7]):
+                moves.extend([move | promotion for promotion in PROMOTIONS])
+            else:
+                moves.append(move)
+            to_squares ^= to_bit
+
+    def _get_castle_moves(self, king, side, occupied, safe, moves):
+        """
+        :param safe: king steps found safe, out of check a slider can not see the square next to the king
+                     through the king, so they are the squares the king passes over
+        """
+        rights = self.castling_rights
+        if side == 0:
+            king_side, queen_side = rights & WHITE_KING_SIDE, rights & WHITE_QUEEN_SIDE
+        else:
+            king_side, queen_side = rights & BLACK_KING_SIDE, rights & BLACK_QUEEN_SIDE
+        enemy = 1 - side
+        if king_side and not occupied & (0b11 << (king + 1)) and safe & (1 << (king + 1)):
+            if not self.attackers(king + 2, enemy, occupied):
+                moves.append(king | (king + 2) << 6 | CASTLE_FLAG)
+        if queen_side and not occupied & (0b111 << (king - 3)) and safe & (1 << (king - 1)):
+            if not self.attackers(king - 2, enemy, occupied):
+                moves.append(king | (king - 2) << 6 | CASTLE_FLAG)
+
+class BitboardGameState(GameState):
+    def __init__(self, win=None):
+        """
+        Same board, logs and flags as GameState; additionally
+        position -- BitboardPosition kept in step with the board, it generates the legal moves,
+                    which are turned into ChessEngine.Move objects only here, for the GUI and the search
+        """
+        super().__init__(win)  # sets up the position through _position_loaded
+
+    def _position_loaded(self):
+        super()._position_loaded()
+        self.position = BitboardPosition(self)
+
+    def make_move(self, move):
+        super().make_move(move)
+        self.position.make_move(from_move(move))
+
+    def undo(self):
+        if len(self.move_log) != 0:
+            self.position.undo()
+        super().undo()
+
+    def to_move(self, move):
+        """
+        :param move: integer move of self.position
+        :return: the ChessEngine.Move of it
+        """
+        promotion = move >> PROMOTION_SHIFT & 7
+        return Move(SQUARES[move & 63], SQUARES[move >> 6 & 63], self.board,
+                    en_passant_possible=move & EN_PASSANT_FLAG != 0, castle_possible=move & CASTLE_FLAG != 0,
+                    promotion_piece=PROMOTION_PIECES[promotion - 1] if promotion else "Q")
+
+    def in_check(self):
+        """
+        :return: current player is in check
+        """
+        return self.position.in_check()
+
+    def square_under_attack(self, r, c):
+        """
+        :param r:
+        :param c:
+        :return: if enemy can attack the square r, c
+        """
+        position = self.position
+        return position.attackers(r * 8 + c, 1 - position.side, position.occupied[0] | position.occupied[1]) != 0
+
+    def attackers_of_square(self, r, c, color=None):
+        """
+        :param r:
+        :param c:
+        :param color: "w" or "b", side whose pieces attack, defaults to the enemy of the side to move
+        :return: list of (row, col) of every piece attacking the square r, c
+        """
+        position = self.position
+        side = 1 - position.side if color is None else "wb".index(color)
+        return [SQUARES[sq] for sq in squares(position.attackers(r * 8 + c, side,
+                                                                 position.occupied[0] | position.occupied[1]))]
+
+    @property
+    def get_valid_moves(self):
+        """
+        :return: legal moves of the bitboard position
+        """
+        moves = [self.to_move(move) for move in self.position.get_valid_moves]
+        if len(moves) == 0:  # either checkmate or stalemate
+            if self.in_check():
+                self.check_mate = True
+            else:
+                self.stale_mate = True
+        return moves
+
+    @property
+    def get_capture_moves(self):
+        """
+        :return: valid captures and promotions, or every valid move when the king is in check
+        """
+        if self.in_check():
+            return self.get_valid_moves
+        return [self.to_move(move) for move in self.position.get_capture_moves]
@@ -0,0 +1,261 @@
+"""
+This file is responsible for:
+ reading games from PGN files and resolving their SAN moves against the legal moves,
+ compiling the opening moves into a binary book file sorted by zobrist key,
+ memory mapping a book and binary searching it for the moves of a position,
+ picking a book move at random weighted by how often it was played.
+
+usage: python ChessBook.py build games.pgn book.bin [--plies N] [--min-count N]
+       python ChessBook.py probe book.bin [--fen FEN]
+"""
+
+import argparse
+import mmap
+import random
+import re
+import struct
+
+import ChessBitboard
+import ChessEngine
+
+BOOK_MAGIC = b"CHESSBK2"  # version 2: en passant is only hashed when the capture is possible
+BOOK_ENTRY = struct.Struct("<QHH")  # zobrist key, move id, weight
+BOOK_PLIES = 20  # plies of every game that go into the book
+MAX_WEIGHT = 0xFFFF
+FILES = "abcdefgh"
+RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+MOVE_NUMBER = re.compile(r"^\d+\.+")  # "12." or "12..." in front of a move, castling "0-0" has no dot
+
+
+def read_pgn_games(path):
+    """
+    streams the games of a PGN file, one game is held in memory at a time
+    :return: generator of (result, list of SAN moves)
+    """
+    result = "*"
+    movetext = []
+    with open(path, encoding="utf-8", errors="replace") as pgn:
+        for line in pgn:
+            line = line.split(";", 1)[0].strip()  # ; starts a comment running to the end of the line
+            if line.startswith("["):
+                if movetext:
+                    yield result, san_tokens(" ".join(movetext))
+                    movetext = []
+                    result = "*"
+                if line.startswith("[Result "):
+                    result = line.split('"')[1]
+            elif line and not line.startswith("%"):
+                movetext.append(line)
+    if movetext:
+        yield result, san_tokens(" ".join(movetext))
+
+
+def san_tokens(movetext):
+    """
+    :return: the SAN moves of the main line, without comments, variations, NAGs, move numbers and the result
+    """
+    moves = []
+    depth = 0  # nesting of variations
+    i = 0
+    while i < len(movetext):
+        char = movetext[i]
+        if char == "{":
+            end = movetext.find("}", i)
+            i = len(movetext) if end < 0 else end + 1
+            continue
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif not char.isspace():
+            end = i
+            while end < len(movetext) and not movetext[end].isspace() and movetext[end] not in "{}()":
+                end += 1
+            token = movetext[i:end]
+            i = end
+            if depth == 0 and token not in RESULTS and not token.startswith("$"):
+                token = MOVE_NUMBER.sub("", token)  # "12.e4" and "12...e5" keep only the move
+                if token:
+                    moves.append(token)
+            continue
+        i += 1
+    return moves
+
+
+def san_to_move(gs, san, valid_moves=None):
+    """
+    :param san: standard algebraic notation, e.g. "Nbd7", "exd8=Q+", "O-O"
+    :return: the legal move the notation describes, None when it describes none or several
+    """
+    if valid_moves is None:
+        valid_moves = gs.get_valid_moves
+    san = san.rstrip("+#!?")
+    if san in ("O-O", "0-0", "O-O-O", "0-0-0"):
+        end_col = 6 if len(san) == 3 else 2
+        for move in valid_moves:
+            if move.is_castle_move and move.end_col == end_col:
+                return move
+        return None
+
+    promotion = None
+    if "=" in san:
+        san, promotion = san.split("=", 1)
+        promotion = promotion[:1].upper()
+    elif len(san) > 2 and san[-1] in "QRBN" and san[0] in FILES:
+        san, promotion = san[:-1], san[-1]
+    piece = san[0] if san[0] in "KQRBN" else "P"
+    body = (san[1:] if piece != "P" else san).replace("x", "").replace("-", "")
+    if len(body) < 2 or body[-2] not in FILES or body[-1] not in "12345678":
+        return None
+    end_row, end_col = 8 - int(body[-1]), FILES.index(body[-2])
+    hint = body[:-2]
+
+    found = None
+    for move in valid_moves:
+        if move.end_row != end_row or move.end_col != end_col or move.piece_move[1] != piece:
+            continue
+        if move.is_pawn_promotion and move.promotion_piece != (promotion or "Q"):
+            continue
+        if any((char in FILES and move.start_col != FILES.index(char)) or
+               (char.isdigit() and move.start_row != 8 - int(char)) for char in hint):
+            continue
+        if found is not None:
+            return None  # ambiguous
+        found = move
+    return found
+
+
+def build_book(pgn_paths, book_path, plies=BOOK_PLIES, min_count=1):
+    """
+    counts the moves played in the first plies of every game and writes them sorted by position key
+    :return: (games read, entries written)
+    """
+    counts = {}
+    games = 0
+    gs = ChessBitboard.BitboardGameState()
+    for pgn_path in pgn_paths:
+        for _, sans in read_pgn_games(pgn_path):
+            games += 1
+            gs.load_fen(START_FEN)
+            for san in sans[:plies]:
+                move = san_to_move(gs, san)
+                if move is None:
+                    break  # illegal or unreadable, the rest of the game can not be replayed
+                entry = (gs.zobrist_key, move.move_id)
+                counts[entry] = counts.get(entry, 0) + 1
+                gs.make_move(move)
+
+    entries = sorted(entry for entry, count in counts.items() if count >= min_count)
+    with open(book_path, "wb") as book:
+        book.write(BOOK_MAGIC)
+        for key, move_id in entries:
+            book.write(BOOK_ENTRY.pack(key, move_id, min(counts[(key, move_id)], MAX_WEIGHT)))
+    return games, len(entries)
+
+
+class OpeningBook:
+    """
+    read only view of a book file, the file is memory mapped so opening it costs nothing
+    and lookups touch only the pages the binary search visits
+    """
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(BOOK_MAGIC)] != BOOK_MAGIC:
+            self.close()
+            raise ValueError("%s is not an opening book" % path)
+        self.size = (len(self.data) - len(BOOK_MAGIC)) // BOOK_ENTRY.size
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _key_at(self, index):
+        return struct.unpack_from("<Q", self.data, len(BOOK_MAGIC) + index * BOOK_ENTRY.size)[0]
+
+    def entries(self, key):
+        """
+        :return: list of (move_id, weight) stored for the zobrist key
+        """
+        low, high = 0, self.size
+        while low < high:  # first entry with a key >= key
+            middle = (low + high) // 2
+            if self._key_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        found = []
+        while low < self.size:
+            entry_key, move_id, weight = BOOK_ENTRY.unpack_from(self.data, len(BOOK_MAGIC) + low * BOOK_ENTRY.size)
+            if entry_key != key:
+                break
+            found.append((move_id, weight))
+            low += 1
+        return found
+
+    def choose_move(self, gs, valid_moves, rng=random):
+        """
+        :return: a legal book move for the position picked with probability proportional to its weight,
+                 None when the position is not in the book
+        """
+        moves_by_id = {move.move_id: move for move in valid_moves}
+        candidates = [(moves_by_id[move_id], weight) for move_id, weight in self.entries(gs.zobrist_key)
+                      if move_id in moves_by_id]
+        if not candidates:
+            return None
+        return rng.choices([move for move, _ in candidates], [weight for _, weight in candidates])[0]
+
+
+def open_book(path):
+    """
+    :return: the OpeningBook at path, None when there is no book file
+    """
+    try:
+        return OpeningBook(path)
+    except (OSError, ValueError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="build and inspect opening books")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="compile PGN games into a book file")
+    build.add_argument("pgn", nargs="+", help="PGN files to read")
+    build.add_argument("book", help="book file to write")
+    build.add_argument("--plies", type=int, default=BOOK_PLIES, help="plies of every game to keep")
+    build.add_argument("--min-count", type=int, default=1, help="drop moves played fewer times than this")
+    probe = commands.add_parser("probe", help="list the book moves of a position")
+    probe.add_argument("book")
+    probe.add_argument("--fen", help="position to look up, the start position by default")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        games, entries = build_book(args.pgn, args.book, args.plies, args.min_count)
+        print("%d games, %d book entries written to %s" % (games, entries, args.book))
+        return 0
+
+    book = open_book(args.book)
+    if book is None:
+        print("can not open book %s" % args.book)
+        return 1
+    with book:
+        gs = ChessEngine.GameState()
+        if args.fen:
+            gs.load_fen(args.fen)
+        entries = book.entries(gs.zobrist_key)
+        total = sum(weight for _, weight in entries)
+        for move_id, weight in sorted(entries, key=lambda entry: -entry[1]):
+            print("%s %d %.1f%%" % (ChessEngine.Move.id_to_notation(move_id), weight, 100.0 * weight / total))
+        print("%d book moves" % len(entries))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -6,10 +6,56 @@ This Class is responsible for:
  drawing the pieces.
 """
 
+import random
+
+from ChessScores import square_scores
+
+# zobrist keys, seeded so a position hashes to the same key in every process
+_zobrist_random = random.Random(20240613)
+ZOBRIST_PIECES = {color + piece: [[_zobrist_random.getrandbits(64) for _ in range(8)] for _ in range(8)]
+                  for color in "wb" for piece in "PNBRQK"}
+ZOBRIST_CASTLING = [_zobrist_random.getrandbits(64) for _ in range(16)]  # indexed by GameState.castling_rights
+ZOBRIST_EN_PASSANT = [_zobrist_random.getrandbits(64) for _ in range(8)]  # indexed by en passant column
+ZOBRIST_BLACK_TURN = _zobrist_random.getrandbits(64)
+
+# bits of GameState.castling_rights
+WHITE_KING_SIDE = 1
+BLACK_KING_SIDE = 2
+WHITE_QUEEN_SIDE = 4
+BLACK_QUEEN_SIDE = 8
+ALL_CASTLING_RIGHTS = 15
+
+
+def _castling_masks():
+    """
+    :return: 8x8 table of the rights that survive a move from or to the square,
+             so moving a king or rook, or capturing a rook, clears the matching rights
+    """
+    masks = [[ALL_CASTLING_RIGHTS] * 8 for _ in range(8)]
+    masks[7][4] &= ~(WHITE_KING_SIDE | WHITE_QUEEN_SIDE)
+    masks[7][7] &= ~WHITE_KING_SIDE
+    masks[7][0] &= ~WHITE_QUEEN_SIDE
+    masks[0][4] &= ~(BLACK_KING_SIDE | BLACK_QUEEN_SIDE)
+    masks[0][7] &= ~BLACK_KING_SIDE
+    masks[0][0] &= ~BLACK_QUEEN_SIDE
+    return masks
+
+
+CASTLING_MASKS = _castling_masks()
+
+# the undo stack is one flat preallocated list, STATE_SIZE slots per ply holding the state after that many moves
+STATE_SIZE = 4
+CASTLING_SLOT = 0
+EN_PASSANT_SLOT = 1
+ZOBRIST_SLOT = 2
+SCORE_SLOT = 3
+STATE_STACK_PLIES = 512  # preallocated plies, the stack doubles if a game gets longer
+
 
 class GameState:
-    def __init__(self, win):
+    def __init__(self, win=None):
         """
+        win is the pygame window the game is shown in, None when running headless
         Board is 2d list, each element of list is
         string of two character
         1st character is color
@@ -44,10 +90,227 @@ class GameState:
         self.check_mate = False  # when king have no valid square and is in check
         self.stale_mate = False  # when player have no valid move and king is not in check
         self.en_passant_possible = ()  # Coordinates where the en_passant possible
-        self.en_passant_possible_log = [self.en_passant_possible]
-        self.current_castling_rights = CastleRights(True, True, True, True)
-        self.castle_right_log = [CastleRights(self.current_castling_rights.wkc, self.current_castling_rights.bkc,
-                                              self.current_castling_rights.wqc, self.current_castling_rights.bqc)]
+        self.pins = {}  # pinned pieces of the side to move -> direction from king
+        self.checks = []  # pieces giving check to the side to move
+        self.captures_only = False  # piece generators skip quiet moves, set by get_capture_moves
+        self.castling_rights = ALL_CASTLING_RIGHTS  # WHITE_KING_SIDE | BLACK_KING_SIDE | ... bits
+        self.zobrist_key = 0  # hash of the position, updated by make_move/undo
+        self.score = 0  # material + piece-square score for white, updated by make_move/undo
+        self.piece_squares = {"w": set(), "b": set()}  # (row, col) of every piece by colour, updated by make_move/undo
+        self.state_stack = []  # castling rights, en passant, zobrist key and score of every ply, see STATE_SIZE
+        self.start_halfmove_clock = 0  # FEN clocks of the position the move log starts from
+        self.start_fullmove_number = 1
+        self._position_loaded()
+
+    def load_fen(self, fen):
+        """
+        sets up the position described by a FEN string, the move log starts empty
+        raises ValueError and keeps the current position when the FEN is invalid, castling rights and an
+        en passant square the board contradicts are dropped
+        :param fen: e.g. "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+        """
+        fields = fen.split()
+        if not fields:
+            raise ValueError("empty FEN")
+        board = []
+        for rank in fields[0].split("/"):
+            row = []
+            for char in rank:
+                if char.isdigit():
+                    row.extend(["--"] * int(char))
+                elif char.upper() in self.move_functions:
+                    row.append(("w" if char.isupper() else "b") + char.upper())
+                else:
+                    raise ValueError("invalid piece %r in FEN %r" % (char, fen))
+            board.append(row)
+        if len(board) != 8 or any(len(row) != 8 for row in board):
+            raise ValueError("FEN %r does not describe an 8x8 board" % fen)
+        pieces = [piece for row in board for piece in row]
+        if pieces.count("wK") != 1 or pieces.count("bK") != 1:
+            raise ValueError("FEN %r needs exactly one king per side" % fen)
+        if any(piece[1] == "P" for piece in board[0] + board[7]):
+            raise ValueError("FEN %r has a pawn on the first or last rank" % fen)
+        turn = fields[1] if len(fields) > 1 else "w"
+        if turn not in ("w", "b"):
+            raise ValueError("invalid side to move %r in FEN %r" % (turn, fen))
+        castling = fields[2] if len(fields) > 2 else "-"
+        if castling != "-" and (not castling or any(char not in "KQkq" for char in castling)):
+            raise ValueError("invalid castling rights %r in FEN %r" % (castling, fen))
+        en_passant = fields[3] if len(fields) > 3 else "-"
+        if en_passant != "-" and (len(en_passant) != 2 or en_passant[0] not in Move.files_to_cols or
+                                  en_passant[1] not in ("3", "6")):
+            raise ValueError("invalid en passant square %r in FEN %r" % (en_passant, fen))
+        clocks = fields[4:6]
+        if any(not clock.isdigit() for clock in clocks):
+            raise ValueError("invalid move clocks %r in FEN %r" % (" ".join(clocks), fen))
+
+        # rights and the en passant square the board contradicts are dropped, as if the FEN had "-" there
+        castling_rights = 0
+        for char, right, row, rook_col in (("K", WHITE_KING_SIDE, 7, 7), ("Q", WHITE_QUEEN_SIDE, 7, 0),
+                                           ("k", BLACK_KING_SIDE, 0, 7), ("q", BLACK_QUEEN_SIDE, 0, 0)):
+            color = "w" if char.isupper() else "b"
+            if char in castling and board[row][4] == color + "K" and board[row][rook_col] == color + "R":
+                castling_rights |= right
+        en_passant_possible = ()
+        if en_passant != "-":
+            row, col = Move.ranks_to_rows[en_passant[1]], Move.files_to_cols[en_passant[0]]
+            # white to move: the square is on rank 6, the black pawn that just moved two squares stands below it
+            # and the square it came from is empty, mirrored for black
+            pawn_row, from_row, pawn = (3, 1, "bP") if turn == "w" else (4, 6, "wP")
+            if row == (2 if turn == "w" else 5) and board[row][col] == "--" and board[from_row][col] == "--" and \
+                    board[pawn_row][col] == pawn:
+                en_passant_possible = (row, col)
+
+        # nothing is changed until the whole FEN is known to be valid
+        self.board = board
+        self.white_turn = turn == "w"
+        self.castling_rights = castling_rights
+        self.en_passant_possible = en_passant_possible
+        self.start_halfmove_clock = int(clocks[0]) if clocks else 0
+        self.start_fullmove_number = int(clocks[1]) if len(clocks) > 1 else 1
+        self._position_loaded()
+
+    def get_fen(self):
+        """
+        :return: FEN string of the current position
+        """
+        ranks = []
+        for row in self.board:
+            rank = ""
+            empty = 0
+            for piece in row:
+                if piece == "--":
+                    empty += 1
+                    continue
+                if empty:
+                    rank += str(empty)
+                    empty = 0
+                rank += piece[1] if piece[0] == "w" else piece[1].lower()
+            ranks.append(rank + (str(empty) if empty else ""))
+        rights = self.castling_rights
+        castling = ("K" if rights & WHITE_KING_SIDE else "") + ("Q" if rights & WHITE_QUEEN_SIDE else "") + \
+                   ("k" if rights & BLACK_KING_SIDE else "") + ("q" if rights & BLACK_QUEEN_SIDE else "")
+        if self.en_passant_possible:
+            en_passant = Move.cols_to_files[self.en_passant_possible[1]] + Move.rows_to_ranks[self.en_passant_possible[0]]
+        else:
+            en_passant = "-"
+        # the clocks are derived from the move log instead of being tracked move by move
+        halfmove_clock = self.start_halfmove_clock + len(self.move_log)
+        for i in range(len(self.move_log) - 1, -1, -1):
+            move = self.move_log[i]
+            if move.piece_move[1] == "P" or move.piece_capture != "--":
+                halfmove_clock = len(self.move_log) - 1 - i
+                break
+        black_started = self.white_turn == (len(self.move_log) % 2 == 1)
+        fullmove_number = self.start_fullmove_number + (len(self.move_log) + black_started) // 2
+        return "%s %s %s %s %d %d" % ("/".join(ranks), "w" if self.white_turn else "b", castling or "-", en_passant,
+                                      halfmove_clock, fullmove_number)
+
+    def pack_position(self):
+        """
+        :return: 34 bytes, the board as 64 four bit piece codes then side to move, castling rights and
+                 en passant column (8 when there is none)
+        """
+        codes = [PIECE_CODES[piece] for row in self.board for piece in row]
+        packed = bytearray((codes[i] << 4) | codes[i + 1] for i in range(0, 64, 2))
+        en_passant_col = self.en_passant_possible[1] if self.en_passant_possible else 8
+        packed.append((0 if self.white_turn else 0x80) | self.castling_rights)
+        packed.append(en_passant_col)
+        return bytes(packed)
+
+    def load_packed(self, packed):
+        """
+        sets up the position stored by pack_position, the move log starts empty
+        """
+        if len(packed) != PACKED_SIZE:
+            raise ValueError("packed position has %d bytes, expected %d" % (len(packed), PACKED_SIZE))
+        self.board = [[PIECES_BY_CODE[packed[row * 4 + col // 2] >> 4 if col % 2 == 0 else
+                                      packed[row * 4 + col // 2] & 0xF] for col in range(8)] for row in range(8)]
+        flags = packed[32]
+        self.white_turn = not flags & 0x80
+        self.castling_rights = flags & ALL_CASTLING_RIGHTS
+        en_passant_col = packed[33]
+        if en_passant_col == 8:
+            self.en_passant_possible = ()
+        else:
+            self.en_passant_possible = (2 if self.white_turn else 5, en_passant_col)
+        self.start_halfmove_clock = 0
+        self.start_fullmove_number = 1
+        self._position_loaded()
+
+    def _position_loaded(self):
+        """
+        rebuilds everything derived from board, turn, castling rights and en passant after a position is set up
+        """
+        self.piece_squares = {"w": set(), "b": set()}
+        for row in range(8):
+            for col in range(8):
+                piece = self.board[row][col]
+                if piece != "--":
+                    self.piece_squares[piece[0]].add((row, col))
+                if piece == "wK":
+                    self.white_king_location = (row, col)
+                elif piece == "bK":
+                    self.black_king_location = (row, col)
+        self.move_log = []
+        self.captured_pieces = []
+        self.check_mate = False
+        self.stale_mate = False
+        self.zobrist_key = self.compute_zobrist_key()
+        self.score = self.compute_score()
+        self.state_stack = [0] * (STATE_SIZE * STATE_STACK_PLIES)
+        self.state_stack[CASTLING_SLOT] = self.castling_rights
+        self.state_stack[EN_PASSANT_SLOT] = self.en_passant_possible
+        self.state_stack[ZOBRIST_SLOT] = self.zobrist_key
+        self.state_stack[SCORE_SLOT] = self.score
+
+    def compute_score(self):
+        """
+        :return: material + piece-square score of the position built from scratch, positive favours white
+        """
+        score = 0
+        for color in ("w", "b"):
+            for row, col in self.piece_squares[color]:
+                score += square_scores[self.board[row][col]][row][col]
+        return score
+
+    def compute_zobrist_key(self):
+        """
+        :return: zobrist hash of the position built from scratch
+        """
+        key = 0
+        for row in range(8):
+            for col in range(8):
+                if self.board[row][col] != "--":
+                    key ^= ZOBRIST_PIECES[self.board[row][col]][row][col]
+        if not self.white_turn:
+            key ^= ZOBRIST_BLACK_TURN
+        key ^= ZOBRIST_CASTLING[self.castling_rights]
+        return key ^ self.en_passant_key()
+
+    def en_passant_key(self):
+        """
+        :return: zobrist key of the en passant column, 0 when no pawn of the side to move stands next to
+                 the pawn that just moved two squares, so positions differing only in an unusable
+                 en passant square hash alike (the Polyglot convention)
+        """
+        if not self.en_passant_possible:
+            return 0
+        row, col = self.en_passant_possible
+        pawn_row, pawn = (row + 1, "wP") if self.white_turn else (row - 1, "bP")
+        if (col > 0 and self.board[pawn_row][col - 1] == pawn) or (col < 7 and self.board[pawn_row][col + 1] == pawn):
+            return ZOBRIST_EN_PASSANT[col]
+        return 0
+
+    def repetition_count(self):
+        """
+        :return: how many times the current position occurred in the move log, counting itself
+        """
+        count = 0
+        for ply in range(len(self.move_log), -1, -2):  # same side to move only
+            if self.state_stack[ply * STATE_SIZE + ZOBRIST_SLOT] == self.zobrist_key:
+                count += 1
+        return count
 
     def make_move(self, move):
         """
@@ -56,6 +319,7 @@ class GameState:
         :param move:
         :return:
         """
+        key = self.zobrist_key ^ ZOBRIST_BLACK_TURN ^ ZOBRIST_CASTLING[self.castling_rights] ^ self.en_passant_key()
         self.board[move.start_row][move.start_col] = "--"
         self.board[move.end_row][move.end_col] = move.piece_move
         self.move_log.append(move)
@@ -67,7 +331,7 @@ class GameState:
 
         # pawn promotion
         if move.is_pawn_promotion:
-            self.board[move.end_row][move.end_col] = move.piece_move[0] + "Q"
+            self.board[move.end_row][move.end_col] = move.piece_move[0] + move.promotion_piece
 
         # en passant
         if move.is_en_passant_move:
@@ -88,12 +352,50 @@ class GameState:
                 self.board[move.end_row][move.end_col + 1] = self.board[move.end_row][move.end_col - 2]
                 self.board[move.end_row][move.end_col - 2] = "--"
 
-        self.en_passant_possible_log.append(self.en_passant_possible)
-
         # updating Castling rights
         self.update_castle_right(move)
-        self.castle_right_log.append(CastleRights(self.current_castling_rights.wkc, self.current_castling_rights.bkc,
-                                                  self.current_castling_rights.wqc, self.current_castling_rights.bqc))
+
+        # updating the zobrist key, the score and the piece lists, take out what left a square and add what arrived
+        placed_piece = self.board[move.end_row][move.end_col]
+        own_squares = self.piece_squares[move.piece_move[0]]
+        own_squares.remove((move.start_row, move.start_col))
+        own_squares.add((move.end_row, move.end_col))
+        key ^= ZOBRIST_PIECES[move.piece_move][move.start_row][move.start_col]
+        key ^= ZOBRIST_PIECES[placed_piece][move.end_row][move.end_col]
+        score = self.score - square_scores[move.piece_move][move.start_row][move.start_col] + \
+            square_scores[placed_piece][move.end_row][move.end_col]
+        if move.is_en_passant_move:
+            key ^= ZOBRIST_PIECES[move.piece_capture][move.start_row][move.end_col]
+            score -= square_scores[move.piece_capture][move.start_row][move.end_col]
+            self.piece_squares[move.piece_capture[0]].remove((move.start_row, move.end_col))
+        elif move.piece_capture != "--":
+            key ^= ZOBRIST_PIECES[move.piece_capture][move.end_row][move.end_col]
+            score -= square_scores[move.piece_capture][move.end_row][move.end_col]
+            self.piece_squares[move.piece_capture[0]].remove((move.end_row, move.end_col))
+        if move.is_castle_move:
+            rook = move.piece_move[0] + "R"
+            if move.end_col - move.start_col == 2:
+                rook_start, rook_end = move.end_col + 1, move.end_col - 1
+            else:
+                rook_start, rook_end = move.end_col - 2, move.end_col + 1
+            key ^= ZOBRIST_PIECES[rook][move.end_row][rook_start] ^ ZOBRIST_PIECES[rook][move.end_row][rook_end]
+            score += square_scores[rook][move.end_row][rook_end] - square_scores[rook][move.end_row][rook_start]
+            own_squares.remove((move.end_row, rook_start))
+            own_squares.add((move.end_row, rook_end))
+        key ^= self.en_passant_key()
+        key ^= ZOBRIST_CASTLING[self.castling_rights]
+        self.zobrist_key = key
+        self.score = score
+
+        # push the new state, slots are overwritten in place instead of allocating per move objects
+        stack = self.state_stack
+        base = len(self.move_log) * STATE_SIZE
+        if base + STATE_SIZE > len(stack):
+            stack.extend([0] * len(stack))
+        stack[base + CASTLING_SLOT] = self.castling_rights
+        stack[base + EN_PASSANT_SLOT] = self.en_passant_possible
+        stack[base + ZOBRIST_SLOT] = key
+        stack[base + SCORE_SLOT] = score
 
     def undo(self):
         if len(self.move_log) != 0:
@@ -106,98 +408,180 @@ class GameState:
             elif move.piece_move == "bK":
                 self.black_king_location = (move.start_row, move.start_col)
 
+            own_squares = self.piece_squares[move.piece_move[0]]
+            own_squares.remove((move.end_row, move.end_col))
+            own_squares.add((move.start_row, move.start_col))
+
             # undo en passant move
             if move.is_en_passant_move:
                 self.board[move.end_row][move.end_col] = "--"
                 self.board[move.start_row][move.end_col] = move.piece_capture
-            self.en_passant_possible_log.pop()
-            self.en_passant_possible = self.en_passant_possible_log[-1]
-
-            # undo castle rights
-            self.castle_right_log.pop()  # removing the 2nd castling right
-            new_rights = self.castle_right_log[-1]
-            self.current_castling_rights = CastleRights(new_rights.wkc, new_rights.bkc, new_rights.wqc, new_rights.bqc)
+                self.piece_squares[move.piece_capture[0]].add((move.start_row, move.end_col))
+            elif move.piece_capture != "--":
+                self.piece_squares[move.piece_capture[0]].add((move.end_row, move.end_col))
+
+            # restore castle rights, en passant, zobrist key and score of the previous ply
+            stack = self.state_stack
+            base = len(self.move_log) * STATE_SIZE
+            self.castling_rights = stack[base + CASTLING_SLOT]
+            self.en_passant_possible = stack[base + EN_PASSANT_SLOT]
+            self.zobrist_key = stack[base + ZOBRIST_SLOT]
+            self.score = stack[base + SCORE_SLOT]
 
             # undo castle move
             if move.is_castle_move:
                 if move.end_col - move.start_col == 2:
-                    self.board[move.end_row][move.end_col + 1] = self.board[move.end_row][move.end_col - 1]
-                    self.board[move.end_row][move.end_col - 1] = "--"
+                    rook_start, rook_end = move.end_col + 1, move.end_col - 1
                 else:
-                    self.board[move.end_row][move.end_col - 2] = self.board[move.end_row][move.end_col + 1]
-                    self.board[move.end_row][move.end_col + 1] = "--"
+                    rook_start, rook_end = move.end_col - 2, move.end_col + 1
+                self.board[move.end_row][rook_start] = self.board[move.end_row][rook_end]
+                self.board[move.end_row][rook_end] = "--"
+                own_squares.remove((move.end_row, rook_end))
+                own_squares.add((move.end_row, rook_start))
 
         self.check_mate = False
         self.stale_mate = False
 
     def update_castle_right(self, move):
-        if move.piece_move == "wK":
-            self.current_castling_rights.wkc = False
-            self.current_castling_rights.wqc = False
-        elif move.piece_move == "bK":
-            self.current_castling_rights.bkc = False
-            self.current_castling_rights.bqc = False
-        elif move.piece_move == "wR":
-            if move.start_row == 7:
-                if move.start_col == 0:  # left rook
-                    self.current_castling_rights.wqc = False
-                elif move.start_col == 7:
-                    self.current_castling_rights.wkc = False
-        elif move.piece_move == "bR":
-            if move.start_row == 0:
-                if move.start_col == 0:  # left rook
-                    self.current_castling_rights.bqc = False
-                elif move.start_col == 7:
-                    self.current_castling_rights.bkc = False
-
-        if move.piece_capture == "wR":
-            if move.end_row == 7:
-                if move.end_col == 0:
-                    self.current_castling_rights.wqc = False
-                elif move.end_col == 7:
-                    self.current_castling_rights.wkc = False
-        elif move.piece_capture == "bR":
-            if move.end_row == 0:
-                if move.end_col == 0:
-                    self.current_castling_rights.bqc = False
-                elif move.end_col == 7:
-                    self.current_castling_rights.bkc = False
+        self.castling_rights &= CASTLING_MASKS[move.start_row][move.start_col] & \
+            CASTLING_MASKS[move.end_row][move.end_col]
 
     @property
     def get_valid_moves(self):
         """
         :return: valid moves considering king's check
         """
-        temp_en_passant_possible = self.en_passant_possible
-        temp_castle_rights = CastleRights(self.current_castling_rights.wkc, self.current_castling_rights.bkc,
-                                          self.current_castling_rights.wqc, self.current_castling_rights.bqc)
-        # generating all moves
-        moves = self._get_all_moves()
-        if self.white_turn:
-            self.get_castle_moves(self.white_king_location[0], self.white_king_location[1], moves)
+        self.pins, self.checks = self.check_for_pins_and_checks()
+        king_row, king_col = self.white_king_location if self.white_turn else self.black_king_location
+        if len(self.checks) > 1:  # double check, only the king can move
+            moves = []
+            self.get_king_moves(king_row, king_col, moves)
         else:
-            self.get_castle_moves(self.black_king_location[0], self.black_king_location[1], moves)
-        # for moves make the move
-        for i in range(len(moves) - 1, -1, -1):
-            self.make_move(moves[i])
-            # generate all opponent's move
-            # for all opponent's move see if attacking king
-            self.white_turn = not self.white_turn  # because the move function swap the turns so need to swap them again
-            if self.in_check():
-                moves.remove(moves[i])  # if they do it's not a valid move
-            self.white_turn = not self.white_turn
-            self.undo()
+            moves = self._get_all_moves()
+            if len(self.checks) == 1:
+                # every other piece has to capture the checking piece or block its ray
+                check_row, check_col, d_row, d_col = self.checks[0]
+                valid_squares = {(check_row, check_col)}
+                if self.board[check_row][check_col][1] != "N":
+                    for i in range(1, 8):
+                        square = (king_row + d_row * i, king_col + d_col * i)
+                        valid_squares.add(square)
+                        if square == (check_row, check_col):
+                            break
+                moves = [move for move in moves if move.piece_move[1] == "K" or
+                         (move.end_row, move.end_col) in valid_squares or
+                         (move.is_en_passant_move and (move.start_row, move.end_col) == (check_row, check_col))]
+            else:
+                self.get_castle_moves(king_row, king_col, moves)
+        # king moves are generated pseudo-legally, keep the ones that do not walk into an attack
+        moves = [move for move in moves if move.piece_move[1] != "K" or move.is_castle_move or
+                 self._king_move_safe(move.end_row, move.end_col)]
         if len(moves) == 0:  # either checkmate or stalemate
-            if self.in_check():
+            if len(self.checks) != 0:
                 self.check_mate = True
             else:
                 self.stale_mate = True
 
-        self.en_passant_possible = temp_en_passant_possible
-        self.current_castling_rights = temp_castle_rights
-
         return moves
 
+    @property
+    def get_capture_moves(self):
+        """
+        :return: valid captures and promotions, or every valid move when the king is in check
+        """
+        self.pins, self.checks = self.check_for_pins_and_checks()
+        if len(self.checks) != 0:
+            return self.get_valid_moves
+        self.captures_only = True
+        moves = self._get_all_moves()
+        self.captures_only = False
+        return [move for move in moves if move.piece_move[1] != "K" or self._king_move_safe(move.end_row, move.end_col)]
+
+    def check_for_pins_and_checks(self):
+        """
+        walks outward from the king of the side to move
+        :return: pins -- dict (row, col) of pinned piece -> direction from king to it,
+                 checks -- list of (row, col, d_row, d_col) of checking pieces
+        """
+        pins = {}
+        checks = []
+        if self.white_turn:
+            enemy_color, ally_color = "b", "w"
+            start_row, start_col = self.white_king_location
+        else:
+            enemy_color, ally_color = "w", "b"
+            start_row, start_col = self.black_king_location
+        directions = ((-1, 0), (0, -1), (1, 0), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1))
+        for j in range(len(directions)):
+            d = directions[j]
+            possible_pin = ()
+            for i in range(1, 8):
+                end_row = start_row + d[0] * i
+                end_col = start_col + d[1] * i
+                if 0 <= end_row < 8 and 0 <= end_col < 8:
+                    end_piece = self.board[end_row][end_col]
+                    # the king itself is ignored so a king stepping along a ray stays attacked
+                    if end_piece[0] == ally_color and end_piece[1] != "K":
+                        if possible_pin == ():
+                            possible_pin = (end_row, end_col)
+                        else:  # 2nd allied piece, no pin or check in this direction
+                            break
+                    elif end_piece[0] == enemy_color:
+                        piece_type = end_piece[1]
+                        # 1. orthogonally away from king and piece is rook
+                        # 2. diagonally away from king and piece is bishop
+                        # 3. 1 square diagonally in front of king and piece is pawn
+                        # 4. any direction and piece is queen
+                        # 5. any direction 1 square away and piece is king
+                        if (0 <= j <= 3 and piece_type == "R") or \
+                                (4 <= j <= 7 and piece_type == "B") or \
+                                (i == 1 and piece_type == "P" and (
+                                        (enemy_color == "w" and 6 <= j <= 7) or
+                                        (enemy_color == "b" and 4 <= j <= 5))) or \
+                                (piece_type == "Q") or (i == 1 and piece_type == "K"):
+                            if possible_pin == ():
+                                checks.append((end_row, end_col, d[0], d[1]))
+                            else:
+                                pins[possible_pin] = d
+                        break  # enemy piece blocks any further pin or check
+                else:
+                    break
+        knight_moves = ((-2, -1), (-2, 1), (2, 1), (2, -1), (-1, -2), (1, -2), (1, 2), (-1, 2))
+        for m in knight_moves:
+            end_row = start_row + m[0]
+            end_col = start_col + m[1]
+            if 0 <= end_row < 8 and 0 <= end_col < 8:
+                if self.board[end_row][end_col] == enemy_color + "N":
+                    checks.append((end_row, end_col, m[0], m[1]))
+        return pins, checks
+
+    def _king_move_safe(self, r, c):
+        """
+        :return: king of the side to move would not be in check on r, c
+        """
+        if self.white_turn:
+            return len(self._attackers(r, c, "b", True, self.white_king_location)) == 0
+        return len(self._attackers(r, c, "w", True, self.black_king_location)) == 0
+
+    def _en_passant_exposes_king(self, r, c, capture_col):
+        """
+        en passant removes two pawns from the king's row at once, which pins can not see
+        :return: capturing from r, c onto capture_col leaves the king attacked along the row
+        """
+        king_row, king_col = self.white_king_location if self.white_turn else self.black_king_location
+        if king_row != r:
+            return False
+        enemy_color = "b" if self.white_turn else "w"
+        step = 1 if king_col < c else -1
+        end_col = king_col + step
+        while 0 <= end_col < 8:
+            if end_col != c and end_col != capture_col:
+                end_piece = self.board[r][end_col]
+                if end_piece != "--":
+                    return end_piece[0] == enemy_color and end_piece[1] in ("R", "Q")
+            end_col += step
+        return False
+
     def in_check(self):
         """
         :return: current player is in check
@@ -213,72 +597,111 @@ class GameState:
         :param c:
         :return: if enemy can attack the square r, c
         """
-        self.white_turn = not self.white_turn
-        opp_moves = self._get_all_moves()
-        self.white_turn = not self.white_turn
-        for move in opp_moves:
-            if move.end_row == r and move.end_col == c:
-                return True
-        return False
+        return len(self._attackers(r, c, "b" if self.white_turn else "w", True)) != 0
+
+    def attackers_of_square(self, r, c, color=None):
+        """
+        :param r:
+        :param c:
+        :param color: "w" or "b", side whose pieces attack, defaults to the enemy of the side to move
+        :return: list of (row, col) of every piece attacking the square r, c
+        """
+        if color is None:
+            color = "b" if self.white_turn else "w"
+        return self._attackers(r, c, color)
+
+    def _attackers(self, r, c, enemy_color, first_only=False, ignore=()):
+        """
+        casts rays and jumps outward from r, c instead of generating the enemy moves
+        :param first_only: stop at the first attacker found
+        :param ignore: (row, col) treated as empty, e.g. the king that is about to step away
+        :return: list of (row, col) of enemy pieces attacking r, c
+        """
+        attackers = []
+        directions = ((-1, 0), (0, -1), (1, 0), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1))
+        for j in range(len(directions)):
+            d = directions[j]
+            for i in range(1, 8):
+                end_row = r + d[0] * i
+                end_col = c + d[1] * i
+                if 0 <= end_row < 8 and 0 <= end_col < 8:
+                    end_piece = self.board[end_row][end_col]
+                    if end_piece == "--" or (end_row, end_col) == ignore:
+                        continue
+                    if end_piece[0] == enemy_color:
+                        piece_type = end_piece[1]
+                        if piece_type == "Q" or (j <= 3 and piece_type == "R") or (j >= 4 and piece_type == "B") or \
+                                (i == 1 and piece_type == "K"):
+                            attackers.append((end_row, end_col))
+                            if first_only:
+                                return attackers
+                    break
+                else:
+                    break
+        knight_moves = ((-2, -1), (-2, 1), (2, 1), (2, -1), (-1, -2), (1, -2), (1, 2), (-1, 2))
+        for m in knight_moves:
+            end_row = r + m[0]
+            end_col = c + m[1]
+            if 0 <= end_row < 8 and 0 <= end_col < 8 and self.board[end_row][end_col] == enemy_color + "N":
+                attackers.append((end_row, end_col))
+                if first_only:
+                    return attackers
+        # a pawn attacks diagonally towards the side it moves to
+        pawn_row = r - 1 if enemy_color == "b" else r + 1
+        if 0 <= pawn_row < 8:
+            for end_col in (c - 1, c + 1):
+                if 0 <= end_col < 8 and self.board[pawn_row][end_col] == enemy_color + "P":
+                    attackers.append((pawn_row, end_col))
+                    if first_only:
+                        return attackers
+        return attackers
 
     def _get_all_moves(self):
         """
         :return: valid moves ignores king's check
         """
         moves = []
-        for row in range(len(self.board)):
-            for col in range(len(self.board[row])):
-                turn = self.board[row][col][0]
-                if (turn == "w" and self.white_turn) or (turn == "b" and not self.white_turn):
-                    piece = self.board[row][col][1]
-                    self.move_functions[piece](row, col, moves)
+        for row, col in self.piece_squares["w" if self.white_turn else "b"]:
+            self.move_functions[self.board[row][col][1]](row, col, moves)
         return moves
 
     def get_pawn_moves(self, r, c, moves):
+        pin = self.pins.get((r, c))
         if self.white_turn:
-            if self.board[r - 1][c] == "--":
-                moves.append(Move((r, c), (r - 1, c), self.board))
-                if r == 6 and self.board[r - 2][c] == "--":
-                    moves.append(Move((r, c), (r - 2, c), self.board))
-            if c - 1 >= 0:
-                if self.board[r - 1][c - 1][0] == "b":
-                    moves.append(Move((r, c), (r - 1, c - 1), self.board))
-                elif (r - 1, c - 1) == self.en_passant_possible:
-                    moves.append(Move((r, c), (r - 1, c - 1), self.board, en_passant_possible=True))
-
-            if c + 1 <= 7:
-                if self.board[r - 1][c + 1][0] == "b":
-                    moves.append(Move((r, c), (r - 1, c + 1), self.board))
-                elif (r - 1, c + 1) == self.en_passant_possible:
-                    moves.append(Move((r, c), (r - 1, c + 1), self.board, en_passant_possible=True))
-
+            move_amount, start_row, enemy_color = -1, 6, "b"
         else:
-            if self.board[r + 1][c] == "--":
-                moves.append(Move((r, c), (r + 1, c), self.board))
-                if r == 1 and self.board[r + 2][c] == "--":
-                    moves.append(Move((r, c), (r + 2, c), self.board))
-            if c - 1 >= 0:
-                if self.board[r + 1][c - 1][0] == "w":
-                    moves.append(Move((r, c), (r + 1, c - 1), self.board))
-                elif (r + 1, c - 1) == self.en_passant_possible:
-                    moves.append(Move((r, c), (r + 1, c - 1), self.board, en_passant_possible=True))
-            if c + 1 <= 7:
-                if self.board[r + 1][c + 1][0] == "w":
-                    moves.append(Move((r, c), (r + 1, c + 1), self.board))
-                elif (r + 1, c + 1) == self.en_passant_possible:
-                    moves.append(Move((r, c), (r + 1, c + 1), self.board, en_passant_possible=True))
+            move_amount, start_row, enemy_color = 1, 1, "w"
+
+        if self.board[r + move_amount][c] == "--" and (not self.captures_only or r + move_amount in (0, 7)):
+            if pin is None or pin[1] == 0:  # pinned along the file the pawn can still push
+                append_pawn_move(moves, (r, c), (r + move_amount, c), self.board)
+                if r == start_row and self.board[r + 2 * move_amount][c] == "--" and not self.captures_only:
+                    moves.append(Move((r, c), (r + 2 * move_amount, c), self.board))
+        for d_col in (-1, 1):
+            if 0 <= c + d_col <= 7:
+                if pin is not None and pin != (move_amount, d_col) and pin != (-move_amount, -d_col):
+                    continue
+                if self.board[r + move_amount][c + d_col][0] == enemy_color:
+                    append_pawn_move(moves, (r, c), (r + move_amount, c + d_col), self.board)
+                elif (r + move_amount, c + d_col) == self.en_passant_possible:
+                    if not self._en_passant_exposes_king(r, c, c + d_col):
+                        moves.append(Move((r, c), (r + move_amount, c + d_col), self.board, en_passant_possible=True))
 
     def get_rook_moves(self, r, c, moves):
         directions = ((-1, 0), (0, -1), (1, 0), (0, 1))
         enemy_color = "b" if self.white_turn else "w"
+        pin = self.pins.get((r, c))
         for d in directions:
+            if pin is not None and pin != d and pin != (-d[0], -d[1]):
+                continue  # pinned piece can only slide along the pin
             for i in range(1, 8):
                 end_row = r + d[0] * i
                 end_col = c + d[1] * i
                 if 0 <= end_row < 8 and 0 <= end_col < 8:
                     end_piece = self.board[end_row][end_col]
                     if end_piece == "--":
-                        moves.append(Move((r, c), (end_row, end_col), self.board))
+                        if not self.captures_only:
+                            moves.append(Move((r, c), (end_row, end_col), self.board))
                     elif end_piece[0] == enemy_color:
                         moves.append(Move((r, c), (end_row, end_col), self.board))
                         break
@@ -288,6 +711,8 @@ class GameState:
                     break
 
     def get_knight_moves(self, r, c, moves):
+        if (r, c) in self.pins:
+            return  # a pinned knight can never stay on the pin line
         knight_move = ((-2, -1), (-2, 1), (2, 1), (2, -1), (-1, -2), (1, -2), (1, 2), (-1, 2))
         friend_color = "w" if self.white_turn else "b"
         for m in knight_move:
@@ -295,20 +720,24 @@ class GameState:
             end_col = c + m[1]
             if 0 <= end_row < 8 and 0 <= end_col < 8:
                 end_piece = self.board[end_row][end_col]
-                if end_piece[0] != friend_color:
+                if end_piece[0] != friend_color and not (self.captures_only and end_piece == "--"):
                     moves.append(Move((r, c), (end_row, end_col), self.board))
 
     def get_bishop_moves(self, r, c, moves):
         directions = ((-1, -1), (-1, 1), (1, -1), (1, 1))
         enemy_color = "b" if self.white_turn else "w"
+        pin = self.pins.get((r, c))
         for d in directions:
+            if pin is not None and pin != d and pin != (-d[0], -d[1]):
+                continue  # pinned piece can only slide along the pin
             for i in range(1, 8):
                 end_row = r + d[0] * i
                 end_col = c + d[1] * i
                 if 0 <= end_row < 8 and 0 <= end_col < 8:
                     end_piece = self.board[end_row][end_col]
                     if end_piece == "--":
-                        moves.append(Move((r, c), (end_row, end_col), self.board))
+                        if not self.captures_only:
+                            moves.append(Move((r, c), (end_row, end_col), self.board))
                     elif end_piece[0] == enemy_color:
                         moves.append(Move((r, c), (end_row, end_col), self.board))
                         break
@@ -325,28 +754,26 @@ class GameState:
             end_col = c + king_moves[i][1]
             if 0 <= end_row < 8 and 0 <= end_col < 8:
                 end_piece = self.board[end_row][end_col]
-                if end_piece[0] != friend_color:
+                if end_piece[0] != friend_color and not (self.captures_only and end_piece == "--"):
                     moves.append(Move((r, c), (end_row, end_col), self.board))
 
     def get_castle_moves(self, r, c, moves):
-        if self.square_under_attack(r, c):
+        if len(self.checks) != 0:
             return  # castling is not allowed
-        if (self.white_turn and self.current_castling_rights.wkc) or \
-                (not self.white_turn and self.current_castling_rights.bkc):
+        if self.castling_rights & (WHITE_KING_SIDE if self.white_turn else BLACK_KING_SIDE):
             self.get_king_side_castle_move(r, c, moves)
 
-        if (self.white_turn and self.current_castling_rights.wqc) or \
-                (not self.white_turn and self.current_castling_rights.bqc):
+        if self.castling_rights & (WHITE_QUEEN_SIDE if self.white_turn else BLACK_QUEEN_SIDE):
             self.get_queen_side_castle_move(r, c, moves)
 
     def get_king_side_castle_move(self, r, c, moves):
         if self.board[r][c + 1] == "--" and self.board[r][c + 2] == "--":
-            if not self.square_under_attack(r, c + 1) and not self.square_under_attack(r, c + 2):
+            if self._king_move_safe(r, c + 1) and self._king_move_safe(r, c + 2):
                 moves.append(Move((r, c), (r, c + 2), self.board, castle_possible=True))
 
     def get_queen_side_castle_move(self, r, c, moves):
         if self.board[r][c - 1] == "--" and self.board[r][c - 2] == "--" and self.board[r][c - 3] == "--":
-            if not self.square_under_attack(r, c - 1) and not self.square_under_attack(r, c - 2):
+            if self._king_move_safe(r, c - 1) and self._king_move_safe(r, c - 2):
                 moves.append(Move((r, c), (r, c - 2), self.board, castle_possible=True))
 
     def get_queen_moves(self, r, c, moves):
@@ -354,17 +781,34 @@ class GameState:
         self.get_bishop_moves(r, c, moves)
 
 
-class CastleRights:
-    """w:white, b:black, c: castle, k: king, q: queen"""
+PROMOTION_PIECES = ("Q", "R", "B", "N")
+
+# four bit piece codes of the packed position encoding
+PIECES_BY_CODE = ["--", "wP", "wN", "wB", "wR", "wQ", "wK", "bP", "bN", "bB", "bR", "bQ", "bK"]
+PIECE_CODES = {piece: code for code, piece in enumerate(PIECES_BY_CODE)}
+PACKED_SIZE = 34
 
-    def __init__(self, wkc, bkc, wqc, bqc):
-        self.wkc = wkc
-        self.bkc = bkc
-        self.wqc = wqc
-        self.bqc = bqc
+
+def append_pawn_move(moves, start_sq, end_sq, board):
+    """
+    appends the pawn move, once per promotion piece when it reaches the last row
+    """
+    if end_sq[0] == 0 or end_sq[0] == 7:
+        for piece in PROMOTION_PIECES:
+            moves.append(Move(start_sq, end_sq, board, promotion_piece=piece))
+    else:
+        moves.append(Move(start_sq, end_sq, board))
 
 
 class Move:
+    """
+    One move, attributes are fixed by __slots__ so the search can allocate many of them cheaply.
+    move_id packs the move into an int: promotion * 10000 + start_row * 1000 + start_col * 100 + end_row * 10 + end_col
+    where promotion is 1 + index in PROMOTION_PIECES, 0 for other moves
+    """
+    __slots__ = ("start_row", "start_col", "end_row", "end_col", "piece_move", "piece_capture", "move_id",
+                 "is_pawn_promotion", "promotion_piece", "is_en_passant_move", "is_castle_move")
+
     ranks_to_rows = {"1": 7, "2": 6, "3": 5, "4": 4,
                      "5": 3, "6": 2, "7": 1, "8": 0}
     rows_to_ranks = {v: k for k, v in ranks_to_rows.items()}
@@ -372,7 +816,7 @@ class Move:
                      "e": 4, "f": 5, "g": 6, "h": 7}
     cols_to_files = {v: k for k, v in files_to_cols.items()}
 
-    def __init__(self, start_sq, end_sq, board, en_passant_possible=False, castle_possible=False):
+    def __init__(self, start_sq, end_sq, board, en_passant_possible=False, castle_possible=False, promotion_piece="Q"):
         self.start_row = start_sq[0]
         self.start_col = start_sq[1]
         self.end_row = end_sq[0]
@@ -384,6 +828,9 @@ class Move:
         # pawn promotion
         self.is_pawn_promotion = (self.piece_move == "wP" and self.end_row == 0) or (
                 self.piece_move == "bP" and self.end_row == 7)
+        self.promotion_piece = promotion_piece  # piece type the pawn turns into, only used on promotion
+        if self.is_pawn_promotion:
+            self.move_id += (PROMOTION_PIECES.index(promotion_piece) + 1) * 10000
 
         # en_passant
         self.is_en_passant_move = en_passant_possible
@@ -396,8 +843,28 @@ class Move:
             return self.move_id == other.move_id
         return False
 
+    def __hash__(self):
+        return self.move_id
+
     def get_chess_notations(self):
-        return self.get_rank_file(self.start_row, self.start_col) + self.get_rank_file(self.end_row, self.end_col)
+        notation = self.get_rank_file(self.start_row, self.start_col) + self.get_rank_file(self.end_row, self.end_col)
+        if self.is_pawn_promotion:
+            notation += self.promotion_piece.lower()
+        return notation
 
     def get_rank_file(self, r, c):
         return self.cols_to_files[c] + self.rows_to_ranks[r]
+
+    @classmethod
+    def id_to_notation(cls, move_id):
+        """
+        :return: chess notation of a move_id without building the Move, e.g. for moves stored in search tables
+        """
+        promotion, square_digits = divmod(move_id, 10000)
+        start_row, start_col, end_row, end_col = (square_digits // 1000, square_digits // 100 % 10,
+                                                  square_digits // 10 % 10, square_digits % 10)
+        notation = cls.cols_to_files[start_col] + cls.rows_to_ranks[start_row] + \
+            cls.cols_to_files[end_col] + cls.rows_to_ranks[end_row]
+        if promotion:
+            notation += PROMOTION_PIECES[promotion - 1].lower()
+        return notation
@@ -0,0 +1,140 @@
+"""
+This file is responsible for:
+ encoding positions as piece planes, one 8x8 plane of 0/1 per colored piece,
+ stacking the square_scores tables into one weight vector,
+ scoring whole batches of positions with a single matrix product instead of one GameState at a time,
+ streaming FEN files through the batch evaluation.
+
+usage: python ChessEvaluate.py positions.fen [--batch N] [--out scores.txt] [--verify]
+"""
+
+import argparse
+import sys
+
+import numpy as np
+
+import ChessEngine
+from ChessScores import square_scores
+
+PLANE_PIECES = ("wP", "wN", "wB", "wR", "wQ", "wK", "bP", "bN", "bB", "bR", "bQ", "bK")
+PLANE_INDEX = {piece: index for index, piece in enumerate(PLANE_PIECES)}
+FEN_PIECES = {("w" if char.isupper() else "b") + char.upper(): char for char in "PNBRQKpnbrqk"}
+FEN_PLANES = {char: PLANE_INDEX[piece] for piece, char in FEN_PIECES.items()}
+FEATURES = len(PLANE_PIECES) * 64  # length of a flattened position, plane * 64 + row * 8 + col
+BATCH_SIZE = 4096  # positions evaluated per matrix product when streaming a file
+
+
+def fen_planes(fen, out=None):
+    """
+    :param out: uint8 array of FEATURES to fill, a new one when None
+    :return: the flattened piece planes of the board field of fen
+    """
+    planes = np.zeros(FEATURES, dtype=np.uint8) if out is None else out
+    square = 0
+    for char in fen.split(" ", 1)[0]:
+        if char == "/":
+            continue
+        if char.isdigit():
+            square += int(char)
+        else:
+            planes[FEN_PLANES[char] * 64 + square] = 1
+            square += 1
+    return planes
+
+
+def state_planes(gs, out=None):
+    """
+    :return: the flattened piece planes of a GameState
+    """
+    planes = np.zeros(FEATURES, dtype=np.uint8) if out is None else out
+    for color in ("w", "b"):
+        for row, col in gs.piece_squares[color]:
+            planes[PLANE_INDEX[gs.board[row][col]] * 64 + row * 8 + col] = 1
+    return planes
+
+
+def encode_fens(fens):
+    """
+    :return: (len(fens), FEATURES) uint8 array of piece planes
+    """
+    planes = np.zeros((len(fens), FEATURES), dtype=np.uint8)
+    for index, fen in enumerate(fens):
+        fen_planes(fen, planes[index])
+    return planes
+
+
+def square_weights(tables=square_scores):
+    """
+    :param tables: dict piece -> 8x8 signed scores, as ChessScores.square_scores
+    :return: FEATURES int64 vector, entry plane * 64 + square is what that piece on that square adds
+    """
+    return np.array([tables[piece] for piece in PLANE_PIECES], dtype=np.int64).reshape(FEATURES)
+
+
+WEIGHTS = square_weights()
+
+
+def evaluate_batch(planes, weights=WEIGHTS):
+    """
+    static material + piece-square score of every position, the value GameState.score holds,
+    checkmate and stalemate are not detected
+    :param planes: (positions, FEATURES) or (positions, 12, 8, 8) piece planes
+    :return: int64 array of scores, positive favours white
+    """
+    planes = np.asarray(planes).reshape(-1, FEATURES)
+    return planes.astype(weights.dtype, copy=False) @ weights
+
+
+def read_fens(path):
+    """
+    :return: generator of the FEN of every non empty line, text after the FEN fields
+             (e.g. a game result) is dropped
+    """
+    with open(path) as lines:
+        for line in lines:
+            fields = line.split()
+            if fields:
+                yield " ".join(fields[:6])
+
+
+def evaluate_file(path, batch_size=BATCH_SIZE):
+    """
+    :return: generator of (fen, score), batch_size positions are held in memory at a time
+    """
+    fens = []
+    for fen in read_fens(path):
+        fens.append(fen)
+        if len(fens) == batch_size:
+            yield from zip(fens, evaluate_batch(encode_fens(fens)).tolist())
+            fens = []
+    if fens:
+        yield from zip(fens, evaluate_batch(encode_fens(fens)).tolist())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="batch static evaluation of FEN positions")
+    parser.add_argument("fens", help="file with one FEN per line")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE, help="positions per matrix product")
+    parser.add_argument("--out", help="file for the FEN and score lines, stdout by default")
+    parser.add_argument("--verify", action="store_true", help="compare every score with GameState.compute_score")
+    args = parser.parse_args()
+
+    gs = ChessEngine.GameState() if args.verify else None
+    mismatches = 0
+    out = open(args.out, "w") if args.out else sys.stdout
+    try:
+        for fen, score in evaluate_file(args.fens, args.batch):
+            out.write("%s %d\n" % (fen, score))
+            if gs is not None:
+                gs.load_fen(fen)
+                if gs.compute_score() != score:
+                    mismatches += 1
+                    print("mismatch %s: batch %d, GameState %d" % (fen, score, gs.compute_score()), file=sys.stderr)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
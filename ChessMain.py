@@ -6,6 +6,8 @@ import pygame
 import os
 
 import ChessAI  # custom file
+import ChessBitboard  # custom file
+import ChessBook  # custom file
 import ChessEngine  # custom file
 
 pygame.init()
@@ -17,6 +19,11 @@ SQUARE_SIZE = BOARD_HEIGHT // DIMENSION
 FPS = 15
 FONT = pygame.font.SysFont(pygame.font.get_default_font(), 20)
 IMG = {}
+USE_BITBOARDS = True  # False falls back to the plain 8x8 list move generator
+GAME_STATE = ChessBitboard.BitboardGameState if USE_BITBOARDS else ChessEngine.GameState
+AI_WORKERS = 1  # processes the AI searches with, more than 1 splits the root moves between them
+PONDER = True  # the AI keeps thinking on the reply it expects while the human is thinking
+BOOK_PATH = "assets/book.bin"  # opening book built by ChessBook.py, the AI searches every move when it is missing
 # X, Y = 100, 100
 os.environ['SDL_VIDEO_WINDOW_POS'] = "%d, %d" % (100, 100)
 
@@ -29,6 +36,11 @@ def welcome():
     pygame.display.set_caption('Chess With Raj')   
     pygame.display.set_icon(pygame.image.load("assets/raj games icon.png"))
     screen.fill(pygame.Color("white"))
+    images = [pygame.transform.scale(pygame.image.load("assets/one_pawn.png"), (height, height)),
+              pygame.transform.scale(pygame.image.load("assets/two_pawn.png"), (height, height))]
+    screen.blit(images[0], pygame.Rect(0, 0, height, height))
+    screen.blit(images[1], pygame.Rect(height, 0, height, height))
+    pygame.display.flip()  # the screen never changes, it is drawn once
     clock = pygame.time.Clock()
     event_loop = True
 
@@ -41,12 +53,6 @@ def welcome():
                 return 1 if location[0] < width//2 else 2
 
         clock.tick(FPS)
-        pygame.display.flip()
-        images = [pygame.transform.scale(pygame.image.load("assets/one_pawn.png"), (height, height)),
-                  pygame.transform.scale(pygame.image.load("assets/two_pawn.png"), (height, height))]
-
-        screen.blit(images[0], pygame.Rect(0, 0, height, height))
-        screen.blit(images[1], pygame.Rect(height, 0, height, height))
 
     pygame.quit()
     return 0  # if user exited the window
@@ -61,10 +67,13 @@ def main(player_num):
     pygame.display.set_caption('Chess With Raj', "assets/raj games icon.png")
     win.fill(pygame.Color("white"))
 
-    game_state = ChessEngine.GameState(win)
+    game_state = GAME_STATE(win)
     valid_moves = game_state.get_valid_moves
 
     load_images()
+    renderer = Renderer(win)
+    book = ChessBook.open_book(BOOK_PATH)
+    thinker = ChessAI.BackgroundSearch(GAME_STATE, AI_WORKERS)  # the AI searches on a thread, the loop polls it
     clock = pygame.time.Clock()
 
     selected = ()
@@ -110,50 +119,57 @@ def main(player_num):
                             player_clicks = [selected]
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_BACKSPACE:
+                    thinker.cancel()
                     game_state.undo()
                     game_state.undo()
                     move_made = True
                     game_over = False
                 if event.key == pygame.K_RETURN:
-                    game_state = ChessEngine.GameState(win)
+                    thinker.cancel()
+                    game_state = GAME_STATE(win)
                     valid_moves = game_state.get_valid_moves
                     selected = ()
                     player_clicks = []
                     move_made = False
                     game_over = False
 
+        thinker.check_time()
         if not game_over and not is_human_turn:
-            # start_time = time.time()
-            ai_move = ChessAI.find_move_nega_max_alpha_beta(game_state, valid_moves)
-            # print(time.time() - start_time)
-            if ai_move is None:
-                ai_move = ChessAI.random_move(valid_moves)
-            if game_state.board[ai_move.end_row][ai_move.end_col] != "--":
-                capture_pieces.append(game_state.board[ai_move.end_row][ai_move.end_col])
-            game_state.make_move(ai_move)
-            move_made = True
+            ai_move = None
+            reply_id = None
+            if thinker.pondering and thinker.key == game_state.zobrist_key:
+                thinker.ponder_hit()  # the human played the expected move, the pondering search carries on
+            if thinker.key != game_state.zobrist_key:
+                if thinker.busy:
+                    thinker.cancel()  # pondered on another move, the next search starts once it has stopped
+                else:
+                    ai_move = book.choose_move(game_state, valid_moves) if book is not None else None
+                    if ai_move is None:
+                        thinker.start(game_state)
+            elif thinker.done:
+                _, move_id, reply_id = thinker.result
+                ai_move = next((move for move in valid_moves if move.move_id == move_id), None)
+                if ai_move is None:
+                    ai_move = ChessAI.random_move(valid_moves)
+            if ai_move is not None:
+                if game_state.board[ai_move.end_row][ai_move.end_col] != "--":
+                    capture_pieces.append(game_state.board[ai_move.end_row][ai_move.end_col])
+                game_state.make_move(ai_move)
+                move_made = True
+                if PONDER and reply_id is not None:
+                    thinker.start(game_state, reply_id)
 
         if move_made:
             valid_moves = game_state.get_valid_moves
             move_made = False
 
-        draw(win, game_state, valid_moves, selected)
-
         game_over = game_state.check_mate or game_state.stale_mate
-        if game_over:
-            if game_state.white_turn:
-                if game_state.check_mate:
-                    draw_text(win, "Black Wins By Check Mate")
-                else:
-                    draw_text(win, 'Black Wins By Stale Mate')
-            else:
-                if game_state.check_mate:
-                    draw_text(win, "White Wins By Check Mate")
-                else:
-                    draw_text(win, 'White Wins By Stale Mate')
+        renderer.draw(game_state, valid_moves, selected, game_over_text(game_state) if game_over else None)
 
         clock.tick(FPS)
-        pygame.display.flip()
+    thinker.cancel()
+    if book is not None:
+        book.close()
     pygame.quit()
 
 
@@ -164,11 +180,60 @@ def load_images():
         IMG[piece] = pygame.transform.scale(pygame.image.load("assets/" + piece + ".png"), (SQUARE_SIZE, SQUARE_SIZE))
 
 
-def draw(win, game_state, valid_moves, square_selected):
-    draw_square(win)
-    highlight_square(win, game_state, valid_moves, square_selected)
-    draw_piece(win, game_state)
-    pygame.display.update()
+class Renderer:
+    """
+    Draws the empty board once into a cached surface; every frame only the squares whose piece or
+    highlight changed are redrawn and only their rects are pushed to the display.
+    """
+
+    def __init__(self, win):
+        self.win = win
+        self.board_surface = pygame.Surface((BOARD_WIDTH, BOARD_HEIGHT))
+        draw_square(self.board_surface)
+        self.highlight = pygame.Surface((SQUARE_SIZE, SQUARE_SIZE))
+        self.highlight.set_alpha(150)  # transparency
+        self.font = pygame.font.SysFont("helvetica", 35, True, False)
+        self.text_images = {}  # message -> rendered text
+        self.shown = [[None] * DIMENSION for _ in range(DIMENSION)]  # (piece, highlight colours) on screen
+        self.text = None  # message on screen
+
+    def draw(self, game_state, valid_moves, square_selected, text=None):
+        if text != self.text:
+            self.shown = [[None] * DIMENSION for _ in range(DIMENSION)]  # the squares under the old text
+            self.text = text
+        highlights = highlight_square(game_state, valid_moves, square_selected)
+        dirty = []
+        for row in range(DIMENSION):
+            for col in range(DIMENSION):
+                square = (game_state.board[row][col], highlights.get((row, col), ()))
+                if square == self.shown[row][col]:
+                    continue
+                self.shown[row][col] = square
+                rect = pygame.Rect(col * SQUARE_SIZE, row * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE)
+                self.win.blit(self.board_surface, rect, rect)
+                for color in square[1]:
+                    self.highlight.fill(color)
+                    self.win.blit(self.highlight, rect)
+                if square[0] != "--":
+                    self.win.blit(IMG[square[0]], rect)
+                dirty.append(rect)
+        if text is not None and dirty:
+            dirty.append(self.draw_text(text))
+        if dirty:
+            pygame.display.update(dirty)
+
+    def draw_text(self, text):
+        """
+        :return: rect the text was drawn to
+        """
+        if text not in self.text_images:
+            self.text_images[text] = self.font.render(text, True, pygame.Color('Black'))
+        text_object = self.text_images[text]
+        text_location = pygame.Rect(BOARD_WIDTH // 2 - text_object.get_width() // 2,
+                                    BOARD_HEIGHT // 2 - text_object.get_height() // 2,
+                                    text_object.get_width(), text_object.get_height())
+        self.win.blit(text_object, text_location)
+        return text_location
 
 
 def draw_square(win):
@@ -180,41 +245,29 @@ def draw_square(win):
                              pygame.Rect(col * SQUARE_SIZE, row * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE))
 
 
-def highlight_square(win, game_state, valid_moves, square_selected):
+def highlight_square(game_state, valid_moves, square_selected):
+    """
+    :return: dict (row, col) -> colours laid over the square, in drawing order
+    """
+    highlights = {}
     enemy_color = ('b' if game_state.white_turn else 'w')
     if square_selected != ():
         r, c = square_selected
         if game_state.board[r][c][0] != enemy_color:  # sq selected should same which turn it is
-            surface = pygame.Surface((SQUARE_SIZE, SQUARE_SIZE))  # highlight selected square
-            surface.set_alpha(150)  # transparency
-            surface.fill((255, 255, 0))  # yellow
-            win.blit(surface, (c * SQUARE_SIZE, r * SQUARE_SIZE))
+            highlights[(r, c)] = ((255, 255, 0),)  # yellow
             for move in valid_moves:
                 if move.start_row == r and move.start_col == c:
-                    surface.fill((255, 0, 255))  # pink
-                    win.blit(surface, (SQUARE_SIZE * move.end_col, SQUARE_SIZE * move.end_row))
                     if game_state.board[move.end_row][move.end_col][0] == enemy_color:
-                        surface.fill((255, 0, 0))  # red
-                        win.blit(surface, (SQUARE_SIZE * move.end_col, SQUARE_SIZE * move.end_row))
+                        highlights[(move.end_row, move.end_col)] = ((255, 0, 255), (255, 0, 0))  # pink, red
+                    else:
+                        highlights[(move.end_row, move.end_col)] = ((255, 0, 255),)  # pink
+    return highlights
 
 
-def draw_piece(win, game_state):
-    for row in range(DIMENSION):
-        for col in range(DIMENSION):
-            piece = game_state.board[row][col]
-            if piece != "--":
-                win.blit(IMG[piece],
-                         pygame.Rect(col * SQUARE_SIZE, row * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE))
-
-
-def draw_text(win, text):
-    font = pygame.font.SysFont("helvetica", 35, True, False)
-    text_object = font.render(text, True, pygame.Color('Black'))
-    text_location = pygame.Rect(BOARD_WIDTH // 2 - text_object.get_width() // 2,
-                                BOARD_HEIGHT // 2 - text_object.get_height() // 2,
-                                text_object.get_width(), text_object.get_height())
-    win.blit(text_object, text_location)
-    pygame.display.update()
+def game_over_text(game_state):
+    if game_state.white_turn:
+        return "Black Wins By Check Mate" if game_state.check_mate else 'Black Wins By Stale Mate'
+    return "White Wins By Check Mate" if game_state.check_mate else 'White Wins By Stale Mate'
 
 
 if __name__ == "__main__":
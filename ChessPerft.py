@@ -0,0 +1,125 @@
+"""
+This file is responsible for:
+ counting the leaf nodes of the legal move tree (perft) to validate the move generators,
+ printing per move counts (divide) to find where a generator goes wrong,
+ measuring move generation throughput in nodes per second.
+
+usage: python ChessPerft.py [--depth N] [--engine list|bitboard|bitboard-state] [--divide FEN]
+"""
+
+import argparse
+import time
+
+import ChessBitboard
+import ChessEngine
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+# (name, FEN, known node counts for depth 1, 2, 3 ...)
+POSITIONS = [
+    ("start", START_FEN, [20, 400, 8902, 197281, 4865609]),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+     [48, 2039, 97862, 4085603]),
+    ("position 3", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", [14, 191, 2812, 43238, 674624]),
+    ("position 4", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1", [6, 264, 9467, 422333]),
+    ("position 4 mirrored", "r2q1rk1/pP1p2pp/Q4n2/bbp1p3/Np6/1B3NBn/pPPP1PPP/R3K2R b KQ - 0 1",
+     [6, 264, 9467, 422333]),
+    ("position 5", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8", [44, 1486, 62379, 2103487]),
+    ("position 6", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+     [46, 2079, 89890, 3894594]),
+]
+
+# bitboard is the integer move core, bitboard-state the same core behind the Move objects the GUI and search use
+ENGINES = {"list": ChessEngine.GameState, "bitboard": ChessBitboard.BitboardPosition,
+           "bitboard-state": ChessBitboard.BitboardGameState}
+
+
+def perft(gs, depth):
+    """
+    :return: number of legal move sequences of length depth from the position
+    """
+    if isinstance(gs, ChessBitboard.BitboardPosition):
+        return gs.perft(depth)
+    moves = gs.get_valid_moves
+    if depth <= 1:
+        gs.check_mate = gs.stale_mate = False
+        return len(moves) if depth == 1 else 1
+    nodes = 0
+    for move in moves:
+        gs.make_move(move)
+        nodes += perft(gs, depth - 1)
+        gs.undo()
+    return nodes
+
+
+def divide(gs, depth):
+    """
+    :return: dict move notation -> perft(depth - 1) after that move
+    """
+    counts = {}
+    for move in gs.get_valid_moves:
+        gs.make_move(move)
+        counts[notation(move)] = perft(gs, depth - 1)
+        gs.undo()
+    return counts
+
+
+def notation(move):
+    return ChessBitboard.move_notation(move) if isinstance(move, int) else move.get_chess_notations()
+
+
+def new_game_state(state_class, fen):
+    gs = state_class(None)
+    gs.load_fen(fen)
+    return gs
+
+
+def run_suite(state_class, max_depth, positions=POSITIONS):
+    """
+    runs every position up to max_depth (or its deepest known count) and prints the results
+    :return: True when every count matches
+    """
+    all_ok = True
+    total_nodes = 0
+    total_time = 0.0
+    print("%-20s %5s %10s %10s %8s %12s  %s" % ("position", "depth", "nodes", "expected", "seconds", "nodes/sec", ""))
+    for name, fen, expected in positions:
+        for depth in range(1, min(max_depth, len(expected)) + 1):
+            gs = new_game_state(state_class, fen)
+            start_time = time.perf_counter()
+            nodes = perft(gs, depth)
+            elapsed = time.perf_counter() - start_time
+            ok = nodes == expected[depth - 1]
+            all_ok = all_ok and ok
+            total_nodes += nodes
+            total_time += elapsed
+            print("%-20s %5d %10d %10d %8.3f %12.0f  %s" % (name, depth, nodes, expected[depth - 1], elapsed,
+                                                            nodes / elapsed if elapsed else 0, "ok" if ok else "FAIL"))
+    print("total %d nodes in %.3f s, %.0f nodes/sec, %s" % (total_nodes, total_time,
+                                                           total_nodes / total_time if total_time else 0,
+                                                           "all ok" if all_ok else "MISMATCH"))
+    return all_ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="perft validation and benchmark of the move generators")
+    parser.add_argument("--depth", type=int, default=3, help="deepest depth to run (default 3)")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="bitboard", help="move generator to test")
+    parser.add_argument("--divide", metavar="FEN", help="print per move counts of this position instead of the suite")
+    args = parser.parse_args()
+
+    state_class = ENGINES[args.engine]
+    if args.divide:
+        gs = new_game_state(state_class, args.divide)
+        start_time = time.perf_counter()
+        counts = divide(gs, args.depth)
+        elapsed = time.perf_counter() - start_time
+        for notation in sorted(counts):
+            print("%s: %d" % (notation, counts[notation]))
+        print("moves %d nodes %d in %.3f s" % (len(counts), sum(counts.values()), elapsed))
+        return 0
+    return 0 if run_suite(state_class, args.depth) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,74 @@
+"""
+This file is responsible for:
+ running single AI searches on chosen positions outside the game loop,
+ printing the search statistics (nodes, nps, branching factor, cutoff and table hit rates),
+ optionally profiling the search with cProfile and dumping everything as JSON for regression tracking.
+
+usage: python ChessProfile.py [--fen FEN ...] [--time S | --depth N | --nodes N] [--profile] [--out stats.json]
+"""
+
+import argparse
+import json
+
+import ChessAI
+import ChessBitboard
+import ChessEngine
+
+ENGINES = {"list": ChessEngine.GameState, "bitboard": ChessBitboard.BitboardGameState}
+POSITIONS = [
+    "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+    "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+    "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+]
+
+
+def profile_position(state_class, fen, time_limit, depth, nodes, profile):
+    """
+    :return: Searcher.stats() of one search of the position, with its FEN, best move and principal variation
+    """
+    gs = state_class()
+    gs.load_fen(fen)
+    searcher = ChessAI.Searcher()  # every position starts from the same cold table
+    if depth is not None:
+        result = searcher.search(gs, time_limit=None, depth=depth, profile=profile)
+    else:
+        result = searcher.search(gs, time_limit=time_limit, nodes=nodes, profile=profile)
+    stats = result.stats
+    stats["fen"] = fen
+    stats["best_move"] = None if result.move is None else result.move.get_chess_notations()
+    stats["score"] = result.score
+    stats["pv"] = [move.get_chess_notations() for move in result.pv]
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="search statistics and profiles of the AI")
+    parser.add_argument("--fen", action="append", help="position to search, repeatable (default: a small suite)")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="bitboard")
+    parser.add_argument("--time", type=float, default=ChessAI.TIME_LIMIT, help="seconds per position")
+    parser.add_argument("--depth", type=int, help="search to this depth without a time limit")
+    parser.add_argument("--nodes", type=int, help="node budget per position")
+    parser.add_argument("--profile", action="store_true", help="run the searches under cProfile")
+    parser.add_argument("--out", help="JSON file for the statistics of every position")
+    args = parser.parse_args()
+
+    results = []
+    for fen in args.fen or POSITIONS:
+        stats = profile_position(ENGINES[args.engine], fen, None if args.nodes else args.time, args.depth,
+                                 args.nodes, args.profile)
+        results.append(stats)
+        print("%s\n  best %s depth %d nodes %d (%d quiescence) %.3f s %d nps ebf %s cutoffs %.1f%% first %.1f%% "
+              "tt hits %.1f%%" % (fen, stats["best_move"], stats["depth"], stats["nodes"], stats["quiescence_nodes"],
+                                  stats["seconds"], stats["nps"], stats["effective_branching_factor"],
+                                  100 * stats["cutoff_rate"], 100 * stats["first_move_cutoff_rate"],
+                                  100 * stats["tt_hit_rate"]))
+        for name, seconds in sorted(stats.get("cumulative_seconds", {}).items(), key=lambda item: -item[1]):
+            print("  %-18s %8.3f s %5.1f%%" % (name, seconds, 100 * seconds / stats["seconds"]))
+    if args.out:
+        with open(args.out, "w") as out:
+            json.dump(results, out, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,102 @@
+"""
+Evaluation tables shared by the AI and the GameState:
+ piece values, piece-square tables,
+ and square_scores, the two combined into one signed score per piece per square.
+"""
+
+piece_score = {"K": 0, "Q": 10, "R": 5, "B": 5, "N": 4, "P": 2}
+
+knight_scores = [
+    [1, 1, 1, 1, 1, 1, 1, 1],
+    [1, 2, 2, 2, 2, 2, 2, 1],
+    [1, 2, 3, 3, 3, 3, 2, 1],
+    [1, 2, 3, 4, 4, 3, 2, 1],
+    [1, 2, 3, 4, 4, 3, 2, 1],
+    [1, 2, 3, 3, 3, 3, 2, 1],
+    [1, 2, 2, 2, 2, 2, 2, 1],
+    [1, 1, 1, 1, 1, 1, 1, 1]
+]
+
+bishop_scores = [
+    [4, 3, 2, 1, 1, 2, 3, 4],
+    [3, 4, 3, 2, 2, 3, 4, 3],
+    [2, 3, 4, 3, 3, 4, 3, 2],
+    [1, 2, 3, 4, 4, 3, 2, 1],
+    [1, 2, 3, 4, 4, 3, 2, 1],
+    [2, 3, 4, 3, 3, 4, 3, 2],
+    [3, 4, 3, 2, 2, 3, 4, 3],
+    [4, 3, 2, 1, 1, 2, 3, 4]
+]
+
+queen_scores = [
+    [1, 1, 1, 3, 1, 1, 1, 1],
+    [1, 2, 3, 3, 3, 1, 1, 1],
+    [1, 4, 3, 3, 3, 4, 2, 1],
+    [1, 2, 3, 3, 3, 2, 2, 1],
+    [1, 2, 3, 3, 3, 2, 2, 1],
+    [1, 4, 3, 3, 3, 4, 2, 1],
+    [1, 2, 3, 3, 3, 1, 1, 1],
+    [1, 1, 1, 3, 1, 1, 1, 1]
+]
+
+rook_scores = [
+    [4, 3, 4, 4, 4, 4, 3, 4],
+    [4, 4, 4, 4, 4, 4, 4, 4],
+    [1, 1, 2, 3, 3, 2, 1, 1],
+    [1, 2, 3, 4, 4, 3, 2, 1],
+    [1, 2, 3, 4, 4, 3, 2, 1],
+    [1, 1, 2, 3, 3, 2, 1, 1],
+    [4, 4, 4, 4, 4, 4, 4, 4],
+    [4, 3, 4, 4, 4, 4, 3, 4]
+]
+
+white_pawn_scores = [
+    [8, 8, 8, 8, 8, 8, 8, 8],
+    [8, 8, 8, 8, 8, 8, 8, 8],
+    [5, 6, 6, 7, 7, 6, 6, 5],
+    [2, 3, 3, 4, 4, 3, 3, 2],
+    [1, 2, 3, 4, 4, 3, 2, 1],
+    [1, 1, 2, 3, 3, 2, 1, 1],
+    [1, 1, 1, 0, 0, 1, 1, 1],
+    [0, 0, 0, 0, 0, 0, 0, 0]
+]
+
+black_pawn_scores = [
+    [0, 0, 0, 0, 0, 0, 0, 0],
+    [1, 1, 1, 0, 0, 1, 1, 1],
+    [1, 1, 2, 3, 3, 2, 1, 1],
+    [1, 2, 3, 4, 4, 3, 2, 1],
+    [2, 3, 3, 4, 4, 3, 3, 2],
+    [5, 6, 6, 7, 7, 6, 6, 5],
+    [8, 8, 8, 8, 8, 8, 8, 8],
+    [8, 8, 8, 8, 8, 8, 8, 8]
+]
+
+piece_position_scores = {
+    "N": knight_scores,
+    "Q": queen_scores,
+    "B": bishop_scores,
+    "R": rook_scores,
+    "bP": black_pawn_scores,
+    "wP": white_pawn_scores
+}
+
+POSITION_WEIGHT = 10  # a piece-square point is worth this much material
+
+
+def _square_scores():
+    """
+    :return: dict piece -> 8x8 table of what the piece on that square adds to the score,
+             positive for white and negative for black
+    """
+    tables = {}
+    for color, sign in (("w", 1), ("b", -1)):
+        for piece in piece_score:
+            positions = piece_position_scores.get(color + piece, piece_position_scores.get(piece))
+            tables[color + piece] = [[sign * (piece_score[piece] + (positions[row][col] * POSITION_WEIGHT
+                                                                     if positions else 0))
+                                      for col in range(8)] for row in range(8)]
+    return tables
+
+
+square_scores = _square_scores()
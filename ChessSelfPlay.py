@@ -0,0 +1,199 @@
+"""
+This file is responsible for:
+ playing engine-vs-engine games without pygame,
+ spreading the games over a process pool,
+ streaming every finished game to a JSON lines file,
+ reporting win/draw/loss with a confidence interval and the search speed.
+
+usage: python ChessSelfPlay.py --games 200 --workers 8 --player-a nodes=2000 --player-b nodes=4000 --out games.jsonl
+"""
+
+import argparse
+import json
+import math
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import ChessAI
+import ChessBitboard
+import ChessEngine
+
+ENGINES = {"list": ChessEngine.GameState, "bitboard": ChessBitboard.BitboardGameState}
+DEFAULT_SETTINGS = {"engine": "bitboard", "time": None, "nodes": None, "depth": ChessAI.MAX_DEPTH}
+MAX_PLIES = 300  # games still running after this many plies are adjudicated a draw
+FIFTY_MOVE_PLIES = 100
+
+
+def parse_settings(text):
+    """
+    :param text: comma separated key=value pairs, keys engine, time (seconds), nodes and depth
+    :return: dict of AI settings, unspecified keys keep their defaults
+    """
+    settings = dict(DEFAULT_SETTINGS)
+    for item in filter(None, text.split(",")):
+        key, _, value = item.partition("=")
+        key = key.strip()
+        if key not in settings:
+            raise ValueError("unknown AI setting %r" % key)
+        if key == "engine":
+            if value not in ENGINES:
+                raise ValueError("unknown engine %r" % value)
+            settings[key] = value
+        elif key == "time":
+            settings[key] = float(value)
+        else:
+            settings[key] = int(value)
+    if settings["time"] is None and settings["nodes"] is None and settings["depth"] == ChessAI.MAX_DEPTH:
+        settings["depth"] = ChessAI.DEPTH  # without any budget fall back to the fixed search depth
+    return settings
+
+
+def draw_reason(gs, halfmove_clock):
+    """
+    :return: why the game is drawn by rule, None when it is not
+    """
+    if gs.repetition_count() >= 3:
+        return "threefold repetition"
+    if halfmove_clock >= FIFTY_MOVE_PLIES:
+        return "fifty move rule"
+    pieces = [gs.board[row][col] for color in ("w", "b") for row, col in gs.piece_squares[color]
+              if gs.board[row][col][1] != "K"]
+    if len(pieces) == 0 or (len(pieces) == 1 and pieces[0][1] in ("N", "B")):
+        return "insufficient material"
+    return None
+
+
+def play_game(game_number, white_settings, black_settings, random_plies, seed, max_plies=MAX_PLIES):
+    """
+    plays one game, runs in a worker process
+    :param random_plies: number of random opening plies so games are not all identical
+    :return: dict describing the game, result is from white's point of view
+    """
+    rng = random.Random(seed)
+    gs = ENGINES[white_settings["engine"]]()
+    if black_settings["engine"] != white_settings["engine"]:
+        # both players see the same game, the second backend replays every move
+        other = ENGINES[black_settings["engine"]]()
+    else:
+        other = None
+    searchers = {"w": ChessAI.Searcher(), "b": ChessAI.Searcher()}  # each player keeps its own table
+    moves_played = []
+    nodes = 0
+    search_time = 0.0
+    halfmove_clock = 0
+    result, reason = "1/2-1/2", "max plies"
+    while len(moves_played) < max_plies:
+        settings = white_settings if gs.white_turn else black_settings
+        state = gs if other is None or settings is white_settings else other
+        valid_moves = state.get_valid_moves
+        if len(valid_moves) == 0:
+            if state.check_mate:
+                result, reason = ("0-1" if state.white_turn else "1-0"), "checkmate"
+            else:
+                reason = "stalemate"
+            break
+        if len(moves_played) < random_plies:
+            move = rng.choice(valid_moves)
+        else:
+            start_time = time.perf_counter()
+            search = searchers["w" if state.white_turn else "b"].search(state, valid_moves, settings["time"],
+                                                                         settings["nodes"], settings["depth"])
+            search_time += time.perf_counter() - start_time
+            nodes += search.stats["nodes"]
+            move = search.move
+            if move is None:
+                move = ChessAI.random_move(valid_moves)
+        halfmove_clock = 0 if move.piece_move[1] == "P" or move.piece_capture != "--" else halfmove_clock + 1
+        moves_played.append(move.get_chess_notations())
+        for board_state in (gs, other):
+            if board_state is not None:
+                board_state.make_move(next(m for m in board_state.get_valid_moves if m == move))
+        reason_drawn = draw_reason(gs, halfmove_clock)
+        if reason_drawn is not None:
+            reason = reason_drawn
+            break
+    return {"game": game_number, "white": white_settings, "black": black_settings, "result": result,
+            "reason": reason, "plies": len(moves_played), "moves": moves_played, "nodes": nodes,
+            "seconds": round(search_time, 3)}
+
+
+def score_interval(wins, draws, losses, z=1.96):
+    """
+    :return: (score, low, high) of the mean game score with a normal approximation confidence interval
+    """
+    games = wins + draws + losses
+    if games == 0:
+        return 0.5, 0.0, 1.0
+    score = (wins + draws / 2) / games
+    variance = (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score ** 2) / games
+    margin = z * math.sqrt(variance / games)
+    return score, max(0.0, score - margin), min(1.0, score + margin)
+
+
+def elo(score):
+    """
+    :return: elo difference matching an expected score, +-inf at the extremes
+    """
+    if score <= 0:
+        return -math.inf
+    if score >= 1:
+        return math.inf
+    return -400 * math.log10(1 / score - 1)
+
+
+def run(games, workers, settings_a, settings_b, out_path, random_plies, seed, max_plies=MAX_PLIES):
+    """
+    plays the games, A takes white in even games and black in odd ones
+    :return: (wins, draws, losses) of A
+    """
+    wins = draws = losses = 0
+    nodes = 0
+    seconds = 0.0
+    with open(out_path, "w") as out, ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for game_number in range(games):
+            white, black = (settings_a, settings_b) if game_number % 2 == 0 else (settings_b, settings_a)
+            future = pool.submit(play_game, game_number, white, black, random_plies, seed + game_number, max_plies)
+            futures[future] = game_number
+        for future in as_completed(futures):
+            record = future.result()
+            a_is_white = record["game"] % 2 == 0
+            record["player_a"] = "white" if a_is_white else "black"
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            if record["result"] == "1/2-1/2":
+                draws += 1
+            elif (record["result"] == "1-0") == a_is_white:
+                wins += 1
+            else:
+                losses += 1
+            nodes += record["nodes"]
+            seconds += record["seconds"]
+            print("game %d: %s (%s) in %d plies, A +%d =%d -%d" % (record["game"], record["result"], record["reason"],
+                                                                     record["plies"], wins, draws, losses))
+    score, low, high = score_interval(wins, draws, losses)
+    print("A vs B: +%d =%d -%d, score %.3f (95%% CI %.3f-%.3f), elo %+.0f (%+.0f to %+.0f)"
+          % (wins, draws, losses, score, low, high, elo(score), elo(low), elo(high)))
+    print("searched %d nodes in %.1f s, %.0f nodes/sec per worker" % (nodes, seconds, nodes / seconds if seconds else 0))
+    return wins, draws, losses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="headless engine-vs-engine games")
+    parser.add_argument("--games", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=ChessAI.WORKERS)
+    parser.add_argument("--player-a", default="", help="AI settings of A, e.g. time=0.1 or nodes=2000,engine=list")
+    parser.add_argument("--player-b", default="", help="AI settings of B")
+    parser.add_argument("--out", default="selfplay.jsonl", help="JSON lines file, one line per finished game")
+    parser.add_argument("--random-plies", type=int, default=4, help="random opening plies for variety")
+    parser.add_argument("--max-plies", type=int, default=MAX_PLIES)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    run(args.games, args.workers, parse_settings(args.player_a), parse_settings(args.player_b), args.out,
+        args.random_plies, args.seed, args.max_plies)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
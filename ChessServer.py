@@ -0,0 +1,349 @@
+"""
+This file is responsible for:
+ hosting many headless games in one process behind a JSON lines protocol on stdin/stdout or a local socket,
+ keeping a GameState per game session and running the requests of one game one after the other,
+ sending AI move requests to a bounded process pool, each with its own time budget,
+ refusing AI requests once too many are queued, and reading no further requests from a connection
+ that has too many unanswered ones, so clients are slowed down instead of piling work up.
+
+usage: python ChessServer.py [--socket PATH | --port N] [--workers N] [--max-pending N] [--max-games N]
+
+every request is one JSON object per line and is answered by one line carrying the same "id",
+answers can come out of order between games:
+ {"id": 1, "op": "new", "fen": FEN}                    fen is optional, the start position by default
+ {"id": 2, "op": "move", "game": 1, "move": "e2e4"}
+ {"id": 3, "op": "ai", "game": 1, "time": 0.5}          optional "nodes" and "depth", plays the move it finds
+ {"id": 4, "op": "state", "game": 1}
+ {"id": 5, "op": "close", "game": 1}
+ {"id": 6, "op": "stats"}
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import ChessAI
+import ChessBitboard
+import ChessEngine
+import ChessSelfPlay
+
+DEFAULT_TIME = 1.0  # seconds an AI request searches when it does not ask for a time
+MAX_TIME = 10.0  # longest search a request can ask for
+MAX_PENDING = 64  # AI requests queued or running before new ones are refused
+MAX_GAMES = 1000  # sessions held at once
+MAX_INFLIGHT = 16  # unanswered requests of one connection before it is no longer read
+IDLE_SECONDS = 3600  # sessions without a request for this long are closed
+WORKER_TT_SIZE = 1 << 18  # transposition table slots of the Searcher in every worker process
+
+_worker_searcher = None  # Searcher of a pool process, reused by every game the process thinks for
+
+
+def _think(packed, time_limit, nodes, depth):
+    """
+    runs in a pool process: searches the packed position
+    :return: (move_id or None, score for the side to move, move_ids of the principal variation, depth, nodes)
+    """
+    global _worker_searcher
+    if _worker_searcher is None:
+        _worker_searcher = ChessAI.Searcher(tt_size=WORKER_TT_SIZE)
+    gs = ChessBitboard.BitboardGameState()
+    gs.load_packed(packed)
+    result = _worker_searcher.search(gs, None, time_limit, nodes, depth)
+    return (None if result.move is None else result.move.move_id, result.score,
+            [move.move_id for move in result.pv], result.depth, result.stats["nodes"])
+
+
+class RequestError(Exception):
+    """a request that can not be served, its message is sent back to the client"""
+
+
+class Session:
+    """
+    one game, the lock keeps a move request from changing the position an AI request is searching
+    """
+
+    def __init__(self, game_id, fen=None):
+        """
+        raises RequestError unless the position loads and its moves can be generated
+        """
+        if fen is not None and not isinstance(fen, str):
+            raise RequestError("fen has to be a string")
+        self.game_id = game_id
+        self.gs = ChessBitboard.BitboardGameState()
+        if fen:
+            try:
+                self.gs.load_fen(fen)
+                self.gs.get_valid_moves
+            except (ValueError, IndexError, KeyError) as error:
+                raise RequestError("invalid FEN %r: %s" % (fen, error))
+        self.lock = asyncio.Lock()
+        self.last_used = time.time()
+
+    def status(self):
+        """
+        :return: "checkmate", "stalemate", the draw rule that ends the game or "ongoing"
+        """
+        valid_moves = self.gs.get_valid_moves
+        if len(valid_moves) == 0:
+            return "checkmate" if self.gs.check_mate else "stalemate"
+        halfmove_clock = int(self.gs.get_fen().split()[4])
+        return ChessSelfPlay.draw_reason(self.gs, halfmove_clock) or "ongoing"
+
+    def find_move(self, notation):
+        move = next((move for move in self.gs.get_valid_moves if move.get_chess_notations() == notation), None)
+        if move is None:
+            raise RequestError("illegal move %r" % notation)
+        return move
+
+    def describe(self):
+        return {"game": self.game_id, "fen": self.gs.get_fen(), "turn": "w" if self.gs.white_turn else "b",
+                "status": self.status(), "legal_moves": [move.get_chess_notations() for move in self.gs.get_valid_moves],
+                "history": [move.get_chess_notations() for move in self.gs.move_log]}
+
+
+class GameServer:
+    """
+    sessions and the AI process pool shared by every connection
+    """
+
+    def __init__(self, workers=ChessAI.WORKERS, max_pending=MAX_PENDING, max_games=MAX_GAMES):
+        self.workers = workers
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.max_pending = max_pending
+        self.max_games = max_games
+        self.sessions = {}
+        self.next_game_id = 1
+        self.pending = 0  # AI requests queued for or running in the pool
+        self.served = 0
+        self.refused = 0
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+    def session(self, request):
+        game_id = request.get("game")
+        if not isinstance(game_id, int) or isinstance(game_id, bool):
+            raise RequestError("game has to be a game number")
+        session = self.sessions.get(game_id)
+        if session is None:
+            raise RequestError("no game %r" % request.get("game"))
+        session.last_used = time.time()
+        return session
+
+    def play(self, session, move):
+        """
+        plays a legal move, a game whose move fails halfway is closed instead of being kept half updated
+        """
+        try:
+            session.gs.make_move(move)
+        except Exception as error:
+            del self.sessions[session.game_id]
+            raise RequestError("game %d closed, playing %s failed: %s" % (session.game_id, move.get_chess_notations(),
+                                                                         error))
+
+    async def handle(self, request):
+        """
+        :return: answer dict of one request
+        """
+        op = request.get("op")
+        if op == "new":
+            if len(self.sessions) >= self.max_games:
+                raise RequestError("too many games")
+            session = Session(self.next_game_id, request.get("fen"))
+            answer = session.describe()  # the session is only kept once it can be described
+            self.sessions[session.game_id] = session
+            self.next_game_id += 1
+            return answer
+        if op == "stats":
+            return {"games": len(self.sessions), "pending": self.pending, "max_pending": self.max_pending,
+                    "served": self.served, "refused": self.refused}
+        session = self.session(request)
+        async with session.lock:
+            if op == "state":
+                return session.describe()
+            if op == "close":
+                del self.sessions[session.game_id]
+                return {"game": session.game_id, "closed": True}
+            if op == "move":
+                if not isinstance(request.get("move"), str):
+                    raise RequestError("move has to be a string like \"e2e4\"")
+                if session.status() != "ongoing":
+                    raise RequestError("game is over")
+                self.play(session, session.find_move(request["move"]))
+                return session.describe()
+            if op == "ai":
+                return await self.ai_move(session, request)
+        raise RequestError("unknown op %r" % op)
+
+    async def ai_move(self, session, request):
+        """
+        searches in the pool and plays the move found, refused when max_pending requests are already waiting
+        """
+        if session.status() != "ongoing":
+            raise RequestError("game is over")
+        try:
+            time_limit = min(float(request.get("time", DEFAULT_TIME)), MAX_TIME)
+            nodes = None if request.get("nodes") is None else int(request["nodes"])
+            depth = int(request.get("depth", ChessAI.MAX_DEPTH))
+        except (TypeError, ValueError, OverflowError):
+            raise RequestError("time, nodes and depth have to be numbers")
+        if not math.isfinite(time_limit) or time_limit <= 0:
+            raise RequestError("time has to be a positive number of seconds")
+        if self.pending >= self.max_pending:
+            self.refused += 1
+            raise RequestError("busy, %d AI requests pending" % self.pending)
+        self.pending += 1
+        queued = time.time()
+        pool = self.pool
+        try:
+            move_id, score, pv, reached, searched = await asyncio.get_running_loop().run_in_executor(
+                pool, _think, session.gs.pack_position(), time_limit, nodes, depth)
+        except BrokenProcessPool:
+            # a worker process died, the pool refuses all further work until it is replaced
+            if self.pool is pool:  # the first request to notice replaces it
+                pool.shutdown(wait=False)
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            raise RequestError("AI worker crashed, try again")
+        finally:
+            self.pending -= 1
+        self.served += 1
+        valid_moves = session.gs.get_valid_moves
+        move = next((move for move in valid_moves if move.move_id == move_id), None)
+        if move is None:
+            move = ChessAI.random_move(valid_moves)
+        pv_notations = [ChessEngine.Move.id_to_notation(pv_id) for pv_id in pv]
+        self.play(session, move)
+        answer = session.describe()
+        answer.update({"move": move.get_chess_notations(), "score": score, "pv": pv_notations, "depth": reached,
+                       "nodes": searched, "seconds": round(time.time() - queued, 3)})
+        return answer
+
+    async def answer(self, line):
+        """
+        :return: the JSON answer line of a request line, errors are answered instead of raised
+        """
+        request_id = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise RequestError("a request has to be a JSON object")
+            request_id = request.get("id")
+            answer = await self.handle(request)
+            answer.update({"id": request_id, "ok": True})
+        except (RequestError, ValueError) as error:
+            answer = {"id": request_id, "ok": False, "error": str(error)}
+        except Exception as error:  # every request gets an answer, the client would wait forever otherwise
+            answer = {"id": request_id, "ok": False, "error": "internal error: %s: %s" % (type(error).__name__, error)}
+        return json.dumps(answer) + "\n"
+
+    async def serve(self, read_line, write):
+        """
+        answers the requests of one connection concurrently, at most MAX_INFLIGHT at a time
+        :param read_line: coroutine function returning the next line, empty at the end
+        :param write: coroutine function sending an answer line
+        """
+        inflight = asyncio.Semaphore(MAX_INFLIGHT)
+        tasks = set()
+
+        async def run(line):
+            try:
+                await write(await self.answer(line))
+            finally:
+                inflight.release()
+
+        while True:
+            await inflight.acquire()  # stops reading while the connection has too many unanswered requests
+            line = await read_line()
+            if not line:
+                inflight.release()
+                break
+            if not line.strip():
+                inflight.release()
+                continue
+            task = asyncio.create_task(run(line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def serve_stream(self, reader, writer):
+        lock = asyncio.Lock()  # one drain at a time
+
+        async def write(text):
+            async with lock:
+                writer.write(text.encode())
+                await writer.drain()
+
+        try:
+            await self.serve(reader.readline, write)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve_stdin(self):
+        loop = asyncio.get_running_loop()
+
+        async def read_line():
+            return await loop.run_in_executor(None, sys.stdin.readline)
+
+        async def write(text):
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+        await self.serve(read_line, write)
+
+    async def expire_sessions(self, idle_seconds):
+        """
+        closes sessions nobody sent a request for idle_seconds, runs until cancelled
+        """
+        while True:
+            await asyncio.sleep(min(idle_seconds, 60))
+            limit = time.time() - idle_seconds
+            for game_id, session in list(self.sessions.items()):
+                if session.last_used < limit and not session.lock.locked():
+                    del self.sessions[game_id]
+
+
+async def run(args):
+    server = GameServer(args.workers, args.max_pending, args.max_games)
+    expiry = asyncio.create_task(server.expire_sessions(args.idle))
+    try:
+        if args.socket:
+            listener = await asyncio.start_unix_server(server.serve_stream, path=args.socket)
+        elif args.port:
+            listener = await asyncio.start_server(server.serve_stream, "127.0.0.1", args.port)
+        else:
+            await server.serve_stdin()
+            return
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        expiry.cancel()
+        server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="headless multi-game server with a shared AI process pool")
+    listen = parser.add_mutually_exclusive_group()
+    listen.add_argument("--socket", help="unix socket path to listen on instead of stdin/stdout")
+    listen.add_argument("--port", type=int, help="localhost TCP port to listen on instead of stdin/stdout")
+    parser.add_argument("--workers", type=int, default=ChessAI.WORKERS, help="AI processes")
+    parser.add_argument("--max-pending", type=int, default=MAX_PENDING, help="AI requests queued before refusing")
+    parser.add_argument("--max-games", type=int, default=MAX_GAMES, help="sessions held at once")
+    parser.add_argument("--idle", type=float, default=IDLE_SECONDS, help="seconds before an unused session is closed")
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,413 @@
+"""
+This file is responsible for:
+ generating distance-to-mate endgame tables for small piece counts by retrograde analysis,
+ writing every table to disk as one byte per position,
+ memory mapping the tables and probing them for a GameState or a list of pieces,
+ picking the tablebase move of a position.
+
+A table is named after its material, white side first, e.g. KQvK or KRvKB; the side with more material
+is always stored as white and positions with the colours reversed are probed mirrored.
+Castling and en passant are not part of the tables, positions with either are never probed.
+
+usage: python ChessTablebase.py generate [KQvK KRvK ...] [--dir DIR]
+       python ChessTablebase.py probe FEN [--dir DIR]
+"""
+
+import argparse
+import mmap
+import os
+import time
+
+import ChessEngine
+from ChessBitboard import KING_ATTACKS, KNIGHT_ATTACKS, PAWN_ATTACKS, rook_attacks, bishop_attacks
+
+TABLEBASE_DIR = "tablebases"
+TABLE_SUFFIX = ".tb"
+DEFAULT_TABLES = ["KQvK", "KRvK", "KBvK", "KNvK", "KPvK"]
+PIECE_ORDER = "KQRBNP"
+PIECE_VALUES = {"K": 0, "Q": 9, "R": 5, "B": 3, "N": 3, "P": 1}
+PROMOTIONS = "QRBN"
+
+# table bytes: 0 is a draw, otherwise plies to mate + 1; an even number of plies means the side to move
+# is mated, an odd number means the side to move mates
+MAX_PLIES = 252
+ILLEGAL = 255  # only used while generating, written as 0
+STALEMATE = 254  # only used while generating, written as 0
+
+
+def side_key(side):
+    return sum(PIECE_VALUES[kind] for kind in side), side
+
+
+def canonical(white, black):
+    """
+    :param white: piece letters of white in PIECE_ORDER, e.g. "KR"
+    :return: (table name, True when the colours have to be swapped to probe it)
+    """
+    if side_key(white) >= side_key(black):
+        return white + "v" + black, False
+    return black + "v" + white, True
+
+
+def table_pieces(signature):
+    """
+    :return: pieces of the table in index order, e.g. "KRvKB" -> ["wK", "wR", "bK", "bB"]
+    """
+    white, black = signature.split("v")
+    return ["w" + kind for kind in white] + ["b" + kind for kind in black]
+
+
+def normalise(pieces, squares, white_turn):
+    """
+    :param pieces: piece names, e.g. ["wK", "bK", "wQ"] in any order
+    :param squares: square index (row * 8 + col) of every piece
+    :return: (table name, squares in table order, side to move index 0 white 1 black of the table)
+    """
+    order = sorted(range(len(pieces)), key=lambda i: (pieces[i][0] == "b", PIECE_ORDER.index(pieces[i][1])))
+    white = "".join(pieces[i][1] for i in order if pieces[i][0] == "w")
+    black = "".join(pieces[i][1] for i in order if pieces[i][0] == "b")
+    signature, swapped = canonical(white, black)
+    if not swapped:
+        return signature, [squares[i] for i in order], 0 if white_turn else 1
+    order = [i for i in order if pieces[i][0] == "b"] + [i for i in order if pieces[i][0] == "w"]
+    return signature, [squares[i] ^ 56 for i in order], 1 if white_turn else 0
+
+
+def table_index(squares, stm):
+    index = stm
+    for sq in squares:
+        index = (index << 6) | sq
+    return index
+
+
+def attacks(piece, sq, occupied):
+    kind = piece[1]
+    if kind == "N":
+        return KNIGHT_ATTACKS[sq]
+    if kind == "K":
+        return KING_ATTACKS[sq]
+    if kind == "P":
+        return PAWN_ATTACKS[piece[0]][sq]
+    if kind == "R":
+        return rook_attacks(sq, occupied)
+    if kind == "B":
+        return bishop_attacks(sq, occupied)
+    return rook_attacks(sq, occupied) | bishop_attacks(sq, occupied)
+
+
+def in_check(color, pieces, squares):
+    occupied = 0
+    for sq in squares:
+        occupied |= 1 << sq
+    king = squares[pieces.index(color + "K")]
+    for piece, sq in zip(pieces, squares):
+        if piece[0] != color and attacks(piece, sq, occupied) >> king & 1:
+            return True
+    return False
+
+
+def legal_moves(pieces, squares, color):
+    """
+    :return: list of (pieces, squares) after every legal move of color, captured pieces are removed
+             and promoted pawns replaced
+    """
+    occupied = own = 0
+    for piece, sq in zip(pieces, squares):
+        occupied |= 1 << sq
+        if piece[0] == color:
+            own |= 1 << sq
+    children = []
+    for i, (piece, sq) in enumerate(zip(pieces, squares)):
+        if piece[0] != color:
+            continue
+        if piece[1] == "P":
+            step = -8 if color == "w" else 8
+            targets = attacks(piece, sq, occupied) & occupied & ~own
+            if not occupied >> (sq + step) & 1:
+                targets |= 1 << (sq + step)
+                if sq // 8 == (6 if color == "w" else 1) and not occupied >> (sq + 2 * step) & 1:
+                    targets |= 1 << (sq + 2 * step)
+        else:
+            targets = attacks(piece, sq, occupied) & ~own
+        while targets:
+            bit = targets & -targets
+            targets ^= bit
+            target = bit.bit_length() - 1
+            new_pieces, new_squares = list(pieces), list(squares)
+            new_squares[i] = target
+            if occupied & bit:
+                captured = squares.index(target)
+                del new_pieces[captured], new_squares[captured]
+            if in_check(color, new_pieces, new_squares):
+                continue
+            if piece[1] == "P" and target // 8 in (0, 7):
+                at = new_squares.index(target)
+                for kind in PROMOTIONS:
+                    promoted = list(new_pieces)
+                    promoted[at] = color + kind
+                    children.append((promoted, new_squares))
+            else:
+                children.append((new_pieces, new_squares))
+    return children
+
+
+def child_tables(signature):
+    """
+    :return: names of the tables a capture or a promotion leads to
+    """
+    white, black = signature.split("v")
+    children = set()
+    for side, other, white_side in ((white, black, True), (black, white, False)):
+        for i, kind in enumerate(side):
+            if kind == "K":
+                continue
+            rest = side[:i] + side[i + 1:]
+            options = [rest]
+            if kind == "P":
+                options += ["".join(sorted(rest + promoted, key=PIECE_ORDER.index)) for promoted in PROMOTIONS]
+            for option in options:
+                children.add(canonical(option, other)[0] if white_side else canonical(other, option)[0])
+    children.discard(signature)
+    return sorted(children)
+
+
+def decode(byte):
+    """
+    :return: (outcome, plies) for the side to move, outcome 1 win, 0 draw, -1 loss
+    """
+    if byte == 0:
+        return 0, 0
+    plies = byte - 1
+    return (1 if plies % 2 else -1), plies
+
+
+class Tablebases:
+    """
+    lazily memory maps the table files of a directory, tables that are not on disk probe as None
+    """
+    def __init__(self, directory=TABLEBASE_DIR):
+        self.directory = directory
+        self.tables = {}  # table name -> (file, mmap), None when there is no file
+        names = [name[:-len(TABLE_SUFFIX)] for name in os.listdir(directory) if name.endswith(TABLE_SUFFIX)] \
+            if os.path.isdir(directory) else []
+        self.max_pieces = max((len(name) - 1 for name in names), default=0)
+
+    def close(self):
+        for table in self.tables.values():
+            if table is not None:
+                table[1].close()
+                table[0].close()
+        self.tables = {}
+
+    def _table(self, signature):
+        if signature not in self.tables:
+            path = os.path.join(self.directory, signature + TABLE_SUFFIX)
+            if os.path.exists(path):
+                table_file = open(path, "rb")
+                self.tables[signature] = (table_file, mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ))
+            else:
+                self.tables[signature] = None
+        table = self.tables[signature]
+        return None if table is None else table[1]
+
+    def probe_pieces(self, pieces, squares, white_turn):
+        """
+        :return: (outcome, plies) for the side to move, None when the table is missing
+        """
+        signature, table_squares, stm = normalise(pieces, squares, white_turn)
+        table = self._table(signature)
+        if table is None:
+            return None
+        return decode(table[table_index(table_squares, stm)])
+
+    def probe(self, gs):
+        """
+        :return: (outcome, plies) of the position for the side to move, None when it is not covered
+        """
+        if gs.castling_rights or gs.en_passant_possible:
+            return None
+        pieces, squares = [], []
+        for color in ("w", "b"):
+            for row, col in gs.piece_squares[color]:
+                pieces.append(gs.board[row][col])
+                squares.append(row * 8 + col)
+        if len(pieces) > self.max_pieces:
+            return None
+        return self.probe_pieces(pieces, squares, gs.white_turn)
+
+    def best_move(self, gs, valid_moves):
+        """
+        :return: (move, outcome, plies) of the fastest win, a draw or the slowest loss, None when not covered
+        """
+        best = None
+        for move in valid_moves:
+            gs.make_move(move)
+            result = self.probe(gs)
+            gs.undo()
+            if result is None:
+                return None
+            outcome, plies = -result[0], result[1] + 1
+            rank = (outcome, -plies if outcome > 0 else plies)
+            if best is None or rank > best[0]:
+                best = (rank, move, outcome, plies if outcome else 0)
+        if best is None:
+            return None
+        return best[1], best[2], best[3]
+
+
+def open_tablebases(directory=TABLEBASE_DIR):
+    """
+    :return: Tablebases of the directory, None when it holds no tables
+    """
+    tablebases = Tablebases(directory)
+    return tablebases if tablebases.max_pieces else None
+
+
+def generate(signature, directory=TABLEBASE_DIR, log=print):
+    """
+    writes the table of signature and, first, every smaller table it converts into
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, signature + TABLE_SUFFIX)
+    if os.path.exists(path):
+        return
+    for child in child_tables(signature):
+        generate(child, directory, log)
+
+    start_time = time.perf_counter()
+    children = Tablebases(directory)
+    pieces = table_pieces(signature)
+    n = len(pieces)
+    shift = 6 * n
+    board_mask = (1 << shift) - 1
+    size = 2 << shift
+    value = bytearray(size)  # 0 unknown, plies + 1 once resolved, ILLEGAL or STALEMATE
+    counter = bytearray(size)  # legal moves not yet known to lose
+    loss_floor = bytearray(size)  # longest mate among the moves leaving the table that lose
+    buckets = [[] for _ in range(MAX_PLIES + 2)]  # positions resolved at every number of plies
+
+    # every position: mark illegal ones, count the moves and settle the moves that leave the table
+    for index in range(size):
+        stm = index >> shift
+        squares = [(index >> (6 * (n - 1 - i))) & 63 for i in range(n)]
+        if len(set(squares)) < n or any(piece[1] == "P" and sq // 8 in (0, 7) for piece, sq in zip(pieces, squares)):
+            value[index] = ILLEGAL
+            continue
+        color, enemy = ("w", "b") if stm == 0 else ("b", "w")
+        if in_check(enemy, pieces, squares):
+            value[index] = ILLEGAL
+            continue
+        moves = legal_moves(pieces, squares, color)
+        if not moves:
+            if in_check(color, pieces, squares):
+                buckets[0].append(index)
+            else:
+                value[index] = STALEMATE
+            continue
+        not_losing = 0
+        best_win = None
+        worst_loss = 0
+        for child_pieces, child_squares in moves:
+            if child_pieces == pieces:
+                not_losing += 1  # stays in the table, settled by the retrograde passes
+                continue
+            outcome, plies = children.probe_pieces(child_pieces, child_squares, stm == 1)
+            if outcome < 0:
+                best_win = plies + 1 if best_win is None else min(best_win, plies + 1)
+            elif outcome > 0:
+                worst_loss = max(worst_loss, plies + 1)
+            if outcome <= 0:
+                not_losing += 1
+        counter[index] = not_losing
+        loss_floor[index] = worst_loss
+        if best_win is not None:
+            buckets[best_win].append(index)
+        elif not_losing == 0:
+            buckets[worst_loss].append(index)
+    children.close()
+
+    # retrograde passes: positions resolved at plies settle their predecessors at plies + 1 or later
+    for plies in range(MAX_PLIES + 1):
+        for index in buckets[plies]:
+            if value[index]:
+                continue
+            value[index] = plies + 1
+            mover_stm = 1 - (index >> shift)
+            mover = "w" if mover_stm == 0 else "b"
+            board_index = index & board_mask
+            squares = [(board_index >> (6 * (n - 1 - i))) & 63 for i in range(n)]
+            occupied = 0
+            for sq in squares:
+                occupied |= 1 << sq
+            for i, piece in enumerate(pieces):
+                if piece[0] != mover:
+                    continue
+                sq = squares[i]
+                if piece[1] == "P":
+                    step = 8 if mover == "w" else -8  # back towards the pawn's own side
+                    origins = 0
+                    if 1 <= (sq + step) // 8 <= 6 and not occupied >> (sq + step) & 1:
+                        origins |= 1 << (sq + step)
+                        if sq // 8 == (4 if mover == "w" else 3) and not occupied >> (sq + 2 * step) & 1:
+                            origins |= 1 << (sq + 2 * step)
+                else:
+                    origins = attacks(piece, sq, occupied) & ~occupied
+                piece_shift = 6 * (n - 1 - i)
+                base = (mover_stm << shift) | (board_index & ~(63 << piece_shift))
+                while origins:
+                    bit = origins & -origins
+                    origins ^= bit
+                    predecessor = base | ((bit.bit_length() - 1) << piece_shift)
+                    if value[predecessor]:
+                        continue
+                    if plies % 2 == 0:
+                        if plies + 1 <= MAX_PLIES:
+                            buckets[plies + 1].append(predecessor)
+                    else:
+                        counter[predecessor] -= 1
+                        if counter[predecessor] == 0:
+                            buckets[min(max(plies + 1, loss_floor[predecessor]), MAX_PLIES + 1)].append(predecessor)
+        buckets[plies] = None
+
+    table = bytes(0 if byte in (ILLEGAL, STALEMATE) else byte for byte in value)
+    with open(path + ".tmp", "wb") as out:
+        out.write(table)
+    os.replace(path + ".tmp", path)
+    log("%s: %d positions in %.1f s" % (signature, size, time.perf_counter() - start_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="generate and probe endgame tablebases")
+    commands = parser.add_subparsers(dest="command", required=True)
+    generate_command = commands.add_parser("generate", help="build tables by retrograde analysis")
+    generate_command.add_argument("tables", nargs="*", default=DEFAULT_TABLES,
+                                  help="tables such as KQvK or KRvKB (default: every 3 piece table)")
+    generate_command.add_argument("--dir", default=TABLEBASE_DIR)
+    probe_command = commands.add_parser("probe", help="print the tablebase result and move of a position")
+    probe_command.add_argument("fen")
+    probe_command.add_argument("--dir", default=TABLEBASE_DIR)
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        for signature in args.tables:
+            white, black = signature.upper().split("V")
+            generate(canonical(white, black)[0], args.dir)
+        return 0
+
+    tablebases = open_tablebases(args.dir)
+    gs = ChessEngine.GameState()
+    gs.load_fen(args.fen)
+    found = None if tablebases is None else tablebases.best_move(gs, gs.get_valid_moves)
+    if found is None:
+        print("position not covered by the tables in %s" % args.dir)
+        return 1
+    move, outcome, plies = found
+    if outcome:
+        print("%s in %d plies, best move %s" % ("win" if outcome > 0 else "loss", plies, move.get_chess_notations()))
+    else:
+        print("draw, best move %s" % move.get_chess_notations())
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,266 @@
+"""
+This file is responsible for:
+ extracting labelled positions (FEN + game result) from PGN games,
+ tuning piece values and piece-square tables Texel style: the evaluation is mapped to an expected
+ game score with a sigmoid and the mean squared error against the real results is minimised,
+ streaming the position file in vectorised batches so the data set never has to fit in memory,
+ writing the tuned values as a module laid out like ChessScores.
+
+usage: python ChessTune.py extract games.pgn positions.txt [--skip-plies N] [--every N]
+       python ChessTune.py tune positions.txt [--epochs N] [--batch N] [--rate R] [--out ChessScoresTuned.py]
+"""
+
+import argparse
+import inspect
+import math
+import random
+
+import numpy as np
+
+import ChessBitboard
+import ChessBook
+import ChessEvaluate
+import ChessScores
+
+MATERIAL_PIECES = "PNBRQ"  # the king has no value, it is on the board in every position
+TABLE_PIECES = "NBRQ"  # tables shared by both colors, so they are kept symmetric between rank r and 7 - r
+TABLE_NAMES = {"N": "knight_scores", "B": "bishop_scores", "R": "rook_scores", "Q": "queen_scores"}
+RESULT_SCORES = {"1-0": 1.0, "0-1": 0.0, "1/2-1/2": 0.5, "1.0": 1.0, "0.0": 0.0, "0.5": 0.5}
+SKIP_PLIES = 8  # opening plies of a game that are not extracted, they mostly come from books
+K_CANDIDATES = np.linspace(0.1, 10.0, 100)  # sigmoid scales tried before tuning
+
+
+def _parameter_layout():
+    """
+    :return: (dict name -> index of every tuned parameter, (FEATURES, parameters) matrix mapping the
+             parameters to ChessEvaluate square weights)
+    names are "N" for material, ("N", row, col) for the upper half of a symmetric table and ("P", row, col)
+    for the white pawn table, rows 1 - 6
+    """
+    names = list(MATERIAL_PIECES)
+    names += [(piece, row, col) for piece in TABLE_PIECES for row in range(4) for col in range(8)]
+    names += [("P", row, col) for row in range(1, 7) for col in range(8)]
+    index = {name: i for i, name in enumerate(names)}
+    mapping = np.zeros((ChessEvaluate.FEATURES, len(names)), dtype=np.float32)
+    for plane, piece in enumerate(ChessEvaluate.PLANE_PIECES):
+        sign = 1 if piece[0] == "w" else -1
+        kind = piece[1]
+        for row in range(8):
+            for col in range(8):
+                feature = plane * 64 + row * 8 + col
+                if kind in MATERIAL_PIECES:
+                    mapping[feature, index[kind]] = sign
+                if kind in TABLE_PIECES:
+                    mapping[feature, index[(kind, min(row, 7 - row), col)]] = sign
+                elif kind == "P":
+                    white_row = row if sign == 1 else 7 - row
+                    if 1 <= white_row <= 6:
+                        mapping[feature, index[("P", white_row, col)]] = sign
+    return index, mapping
+
+
+PARAMETERS, FEATURE_MAP = _parameter_layout()
+
+
+def initial_parameters():
+    """
+    :return: the parameters of the current ChessScores in score points
+    """
+    weight = ChessScores.POSITION_WEIGHT
+    theta = np.zeros(len(PARAMETERS), dtype=np.float64)
+    for name, i in PARAMETERS.items():
+        if isinstance(name, str):
+            theta[i] = ChessScores.piece_score[name]
+        elif name[0] == "P":
+            theta[i] = ChessScores.white_pawn_scores[name[1]][name[2]] * weight
+        else:
+            theta[i] = ChessScores.piece_position_scores[name[0]][name[1]][name[2]] * weight
+    return theta
+
+
+def read_labelled(path):
+    """
+    :return: generator of (fen, result from white's point of view) of every line "FEN result"
+    """
+    with open(path) as lines:
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            result = RESULT_SCORES.get(fields[-1].strip('[]";'))
+            if result is not None:
+                yield " ".join(fields[:-1][:6]), result
+
+
+def read_batches(path, batch_size):
+    """
+    :return: generator of (features, results) arrays of at most batch_size positions
+    """
+    fens, results = [], []
+    for fen, result in read_labelled(path):
+        fens.append(fen)
+        results.append(result)
+        if len(fens) == batch_size:
+            yield ChessEvaluate.encode_fens(fens).astype(np.float32) @ FEATURE_MAP, np.array(results)
+            fens, results = [], []
+    if fens:
+        yield ChessEvaluate.encode_fens(fens).astype(np.float32) @ FEATURE_MAP, np.array(results)
+
+
+def expected_score(scores, k):
+    """
+    :return: expected game score for white of evaluations, the Texel sigmoid 1 / (1 + 10^(-k * score / 400))
+    """
+    return 1.0 / (1.0 + np.power(10.0, -k * scores / 400.0))
+
+
+def fit_k(path, theta, batch_size, candidates=K_CANDIDATES):
+    """
+    one pass over the data set scoring every candidate sigmoid scale at once
+    :return: (k with the least mean squared error, that error)
+    """
+    errors = np.zeros(len(candidates))
+    count = 0
+    for features, results in read_batches(path, batch_size):
+        scores = features @ theta
+        predicted = expected_score(scores[:, None], candidates[None, :])
+        errors += ((results[:, None] - predicted) ** 2).sum(axis=0)
+        count += len(results)
+    if count == 0:
+        raise ValueError("%s holds no labelled positions" % path)
+    best = int(np.argmin(errors))
+    return float(candidates[best]), float(errors[best] / count)
+
+
+def tune(path, theta, k, epochs, batch_size, rate, log=print):
+    """
+    minimises the mean squared error of expected_score with Adam, one update per batch
+    :return: (tuned parameters, mean error of the last epoch)
+    """
+    theta = theta.copy()
+    moment = np.zeros_like(theta)
+    velocity = np.zeros_like(theta)
+    beta1, beta2, epsilon = 0.9, 0.999, 1e-8
+    steps = 0
+    error = math.nan
+    for epoch in range(epochs):
+        total, count = 0.0, 0
+        for features, results in read_batches(path, batch_size):
+            predicted = expected_score(features @ theta, k)
+            difference = predicted - results
+            total += float((difference ** 2).sum())
+            count += len(results)
+            # d error / d theta of the mean squared error through the sigmoid
+            gradient = features.T @ (difference * predicted * (1 - predicted)) * (2 * k * math.log(10) / 400
+                                                                                     / len(results))
+            steps += 1
+            moment = beta1 * moment + (1 - beta1) * gradient
+            velocity = beta2 * velocity + (1 - beta2) * gradient ** 2
+            theta -= rate * (moment / (1 - beta1 ** steps)) / (np.sqrt(velocity / (1 - beta2 ** steps)) + epsilon)
+        error = total / count
+        log("epoch %d: error %.6f" % (epoch + 1, error))
+    return theta, error
+
+
+def _table_source(name, rows):
+    return "%s = [\n%s\n]\n" % (name, ",\n".join("    [%s]" % ", ".join(str(value) for value in row)
+                                                  for row in rows))
+
+
+def module_source(theta, description):
+    """
+    :return: source of a module laid out like ChessScores holding the rounded parameters,
+             POSITION_WEIGHT is 1 as the tables are already in score points
+    """
+    values = {name: int(round(theta[i])) for name, i in PARAMETERS.items()}
+    weight = ChessScores.POSITION_WEIGHT
+    pieces = ", ".join('"%s": %d' % (piece, 0 if piece == "K" else values[piece]) for piece in ChessScores.piece_score)
+    parts = ['"""\nEvaluation tables shared by the AI and the GameState:\n piece values, piece-square tables,\n'
+             ' and square_scores, the two combined into one signed score per piece per square.\n'
+             'generated by ChessTune.py, %s\n"""\n' % description,
+             "piece_score = {%s}\n" % pieces]
+    for piece in ("N", "B", "Q", "R"):
+        rows = [[values[(piece, min(row, 7 - row), col)] for col in range(8)] for row in range(8)]
+        parts.append(_table_source(TABLE_NAMES[piece], rows))
+    # the rows a pawn never stands on keep their old values
+    white = [[values[("P", row, col)] if 1 <= row <= 6 else ChessScores.white_pawn_scores[row][col] * weight
+              for col in range(8)] for row in range(8)]
+    parts.append(_table_source("white_pawn_scores", white))
+    parts.append(_table_source("black_pawn_scores", white[::-1]))
+    parts.append('piece_position_scores = {\n    "N": knight_scores,\n    "Q": queen_scores,\n'
+                 '    "B": bishop_scores,\n    "R": rook_scores,\n    "bP": black_pawn_scores,\n'
+                 '    "wP": white_pawn_scores\n}\n')
+    parts.append("POSITION_WEIGHT = 1  # the tuned tables are in score points\n\n")
+    parts.append(inspect.getsource(ChessScores._square_scores) + "\n")
+    parts.append("square_scores = _square_scores()\n")
+    return "\n".join(parts)
+
+
+def extract_positions(pgn_paths, out_path, skip_plies=SKIP_PLIES, every=1, seed=1):
+    """
+    replays the games and writes every quiet position (side to move not in check, last move not a capture
+    or promotion) after skip_plies with the game result, games without a result are skipped
+    :param every: keep on average one in every positions
+    :return: (games used, positions written)
+    """
+    rng = random.Random(seed)
+    gs = ChessBitboard.BitboardGameState()
+    games = positions = 0
+    with open(out_path, "w") as out:
+        for pgn_path in pgn_paths:
+            for result, sans in ChessBook.read_pgn_games(pgn_path):
+                if result not in RESULT_SCORES:
+                    continue
+                games += 1
+                gs.load_fen(ChessBook.START_FEN)
+                for ply, san in enumerate(sans):
+                    move = ChessBook.san_to_move(gs, san)
+                    if move is None:
+                        break
+                    gs.make_move(move)
+                    if ply + 1 < skip_plies or move.piece_capture != "--" or move.is_pawn_promotion or \
+                            gs.in_check() or (every > 1 and rng.randrange(every)):
+                        continue
+                    out.write("%s %s\n" % (gs.get_fen(), result))
+                    positions += 1
+    return games, positions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Texel tuning of the evaluation tables")
+    commands = parser.add_subparsers(dest="command", required=True)
+    extract = commands.add_parser("extract", help="write labelled positions of PGN games")
+    extract.add_argument("pgn", nargs="+", help="PGN files to read")
+    extract.add_argument("positions", help="file to write, one \"FEN result\" per line")
+    extract.add_argument("--skip-plies", type=int, default=SKIP_PLIES, help="opening plies of every game to skip")
+    extract.add_argument("--every", type=int, default=1, help="keep on average one in every N quiet positions")
+    extract.add_argument("--seed", type=int, default=1)
+    tuning = commands.add_parser("tune", help="tune the tables on a labelled position file")
+    tuning.add_argument("positions", help="file with one \"FEN result\" per line, result 1-0, 0-1, 1/2-1/2 or 1.0/0.5/0.0")
+    tuning.add_argument("--epochs", type=int, default=10, help="passes over the position file")
+    tuning.add_argument("--batch", type=int, default=ChessEvaluate.BATCH_SIZE, help="positions per update")
+    tuning.add_argument("--rate", type=float, default=0.5, help="Adam step size in score points")
+    tuning.add_argument("--k", type=float, help="sigmoid scale, fitted to the current tables when not given")
+    tuning.add_argument("--out", default="ChessScoresTuned.py", help="module to write the tuned tables to")
+    args = parser.parse_args()
+
+    if args.command == "extract":
+        games, positions = extract_positions(args.pgn, args.positions, args.skip_plies, args.every, args.seed)
+        print("%d games, %d positions written to %s" % (games, positions, args.positions))
+        return 0
+
+    theta = initial_parameters()
+    if args.k is None:
+        k, error = fit_k(args.positions, theta, args.batch)
+        print("k %.2f, error of the current tables %.6f" % (k, error))
+    else:
+        k = args.k
+    theta, error = tune(args.positions, theta, k, args.epochs, args.batch, args.rate)
+    with open(args.out, "w") as out:
+        out.write(module_source(theta, "k %.2f, error %.6f on %s" % (k, error, args.positions)))
+    print("tuned tables written to %s" % args.out)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,227 @@
+"""
+This file is responsible for:
+ speaking the UCI protocol on stdin/stdout so chess GUIs and match runners can drive the engine,
+ setting up positions from "position startpos|fen ... moves ...",
+ running "go" searches on a thread so "stop" and "ponderhit" are handled while it thinks,
+ streaming an info line (depth, score, nodes, nps, time, pv) after every completed depth.
+
+usage: python ChessUCI.py
+"""
+
+import sys
+import threading
+import time
+
+import ChessAI
+import ChessBitboard
+import ChessTablebase
+from ChessScores import square_scores
+
+ENGINE_NAME = "Chess With Raj"
+ENGINE_AUTHOR = "RajWebz"
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+MOVES_TO_GO = 30  # moves the remaining clock time is spread over when the GUI does not send movestogo
+MOVE_OVERHEAD = 50  # milliseconds kept back from the clock for the GUI and process start up
+GO_ARGUMENTS = ("wtime", "btime", "winc", "binc", "movestogo", "depth", "nodes", "movetime", "mate")
+# engine score units of a pawn, averaged over the squares a pawn can stand on, UCI "cp" is 100 per pawn
+PAWN_UNITS = sum(square_scores["wP"][row][col] for row in range(1, 7) for col in range(8)) / 48
+
+
+def parse_go(tokens):
+    """
+    :param tokens: words after "go"
+    :return: dict of the numeric arguments plus "infinite" and "ponder" flags
+    """
+    args = {"infinite": False, "ponder": False}
+    i = 0
+    while i < len(tokens):
+        if tokens[i] in ("infinite", "ponder"):
+            args[tokens[i]] = True
+        elif tokens[i] in GO_ARGUMENTS and i + 1 < len(tokens):
+            args[tokens[i]] = int(tokens[i + 1])
+            i += 1
+        i += 1
+    return args
+
+
+def time_budget(args, white_turn):
+    """
+    :return: seconds to think about this move, None when the search is only limited by depth or nodes
+    """
+    if "movetime" in args:
+        return max(args["movetime"] - MOVE_OVERHEAD, 1) / 1000
+    remaining = args.get("wtime" if white_turn else "btime")
+    if remaining is None:
+        return None
+    increment = args.get("winc" if white_turn else "binc", 0)
+    budget = remaining / max(args.get("movestogo", MOVES_TO_GO), 1) + increment * 3 // 4
+    return max(min(budget, remaining - MOVE_OVERHEAD), 1) / 1000
+
+
+def uci_score(score):
+    """
+    :return: "cp N" (centipawns) or "mate N" for a search score from the side to move's point of view
+    """
+    if abs(score) >= ChessAI.CHECKMATE:
+        return "mate %d" % (1 if score > 0 else -1)  # the search does not keep the distance to mate
+    if abs(score) > ChessAI.TABLEBASE_WIN - ChessTablebase.MAX_PLIES:
+        plies = ChessAI.TABLEBASE_WIN - abs(score)
+        return "mate %d" % ((plies + 1) // 2 if score > 0 else -((plies + 1) // 2))
+    return "cp %d" % round(score * 100 / PAWN_UNITS)
+
+
+class UCIEngine:
+    """
+    holds the position set by the GUI and at most one running search
+    """
+
+    def __init__(self, out=sys.stdout):
+        self.out = out
+        self.lock = threading.Lock()  # info lines come from the search thread
+        self.gs = ChessBitboard.BitboardGameState()
+        self.searcher = ChessAI.Searcher()
+        self.searcher.iteration_callback = self.report
+        self.thread = None
+        self.release = threading.Event()  # set by stop or ponderhit, a pondering or infinite search waits for it
+        self.budget = None  # seconds of the running search once it is no longer pondering
+        self.start_time = 0.0
+
+    def send(self, line):
+        with self.lock:
+            self.out.write(line + "\n")
+            self.out.flush()
+
+    def handle(self, line):
+        """
+        runs one command, a command that fails is answered with an info string and changes nothing
+        :return: False once the GUI sent quit
+        """
+        try:
+            return self._dispatch(line)
+        except Exception as error:  # a bad command must not end the engine in the middle of a game
+            self.send("info string error in %r: %s" % (line, error))
+            return True
+
+    def _dispatch(self, line):
+        tokens = line.split()
+        if not tokens:
+            return True
+        command = tokens[0]
+        if command == "uci":
+            self.send("id name %s" % ENGINE_NAME)
+            self.send("id author %s" % ENGINE_AUTHOR)
+            self.send("option name Ponder type check default false")
+            self.send("uciok")
+        elif command == "isready":
+            self.send("readyok")
+        elif command == "ucinewgame":
+            self.stop()
+            self.searcher.transposition_table.clear()
+        elif command == "position":
+            self.stop()
+            self.set_position(tokens[1:])
+        elif command == "go":
+            args = parse_go(tokens[1:])  # a malformed go leaves a running search alone
+            self.stop()
+            self.go(args)
+        elif command == "stop":
+            self.stop()
+        elif command == "ponderhit":
+            self.ponder_hit()
+        elif command == "quit":
+            self.stop()
+            return False
+        return True  # setoption, debug, register and unknown commands are ignored
+
+    def set_position(self, tokens):
+        """
+        sets up the position on a copy, so an invalid FEN or move keeps the previous position
+        """
+        if tokens and tokens[0] == "fen":
+            end = tokens.index("moves") if "moves" in tokens else len(tokens)
+            fen = " ".join(tokens[1:end])
+        else:
+            end = 1
+            fen = START_FEN
+        gs = ChessBitboard.BitboardGameState()
+        gs.load_fen(fen)
+        for notation in tokens[end + 1:]:
+            move = next((move for move in gs.get_valid_moves if move.get_chess_notations() == notation), None)
+            if move is None:
+                raise ValueError("illegal move %s" % notation)
+            gs.make_move(move)
+        self.gs = gs
+
+    def go(self, args):
+        self.budget = time_budget(args, self.gs.white_turn)
+        wait = args["infinite"] or args["ponder"]
+        self.release.clear()
+        self.searcher.stop_requested = False
+        self.searcher.ponder_deadline = None  # a ponderhit of this go may come before its search starts
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self._search, daemon=True,
+                                       args=(None if wait else self.budget, args.get("nodes"),
+                                             args.get("depth", ChessAI.MAX_DEPTH), wait))
+        self.thread.start()
+
+    def _search(self, time_limit, nodes, depth, wait):
+        """
+        runs on the search thread, a bestmove is sent even when the search fails
+        """
+        valid_moves = []
+        move = reply = None
+        try:
+            valid_moves = self.gs.get_valid_moves
+            if len(valid_moves) != 0:
+                move = self.searcher.search(self.gs, valid_moves, time_limit, nodes, depth).move
+                if move is None:
+                    move = ChessAI.random_move(valid_moves)
+                line = self.searcher.principal_variation(self.gs, move, 2)
+                reply = line[1] if len(line) > 1 else None
+        except Exception as error:  # the GUI waits for a bestmove whatever happened
+            self.send("info string search failed: %s" % error)
+            if move is None and valid_moves:
+                move = valid_moves[0]
+        if wait:
+            self.release.wait()  # UCI: no bestmove for go infinite / go ponder before stop or ponderhit
+        if move is None:
+            self.send("bestmove 0000")
+        elif reply is not None:
+            self.send("bestmove %s ponder %s" % (move.get_chess_notations(), reply.get_chess_notations()))
+        else:
+            self.send("bestmove %s" % move.get_chess_notations())
+
+    def report(self, depth, move, score):
+        elapsed = time.time() - self.start_time
+        nodes = self.searcher.nodes
+        pv = " ".join(m.get_chess_notations() for m in self.searcher.principal_variation(self.gs, move, depth))
+        self.send("info depth %d score %s nodes %d nps %d time %d pv %s"
+                  % (depth, uci_score(score), nodes, nodes / elapsed if elapsed else 0, elapsed * 1000, pv))
+
+    def ponder_hit(self):
+        """
+        the GUI's opponent played the pondered move, the search goes on with the normal time budget
+        """
+        if self.budget is not None:
+            self.searcher.ponder_hit(self.budget)
+        self.release.set()
+
+    def stop(self):
+        if self.thread is not None:
+            self.searcher.stop()
+            self.release.set()
+            self.thread.join()
+            self.thread = None
+
+
+def main():
+    engine = UCIEngine()
+    for line in sys.stdin:
+        if not engine.handle(line.strip()):
+            break
+    engine.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())